@@ -0,0 +1,291 @@
+#!/usr/bin/env python3
+"""bench_md2latex benchmarks MarkdownToLatex on synthetic Markdown corpora and checks the results against a baseline"""
+import argparse
+import json
+import random
+import sys
+import time
+import tracemalloc
+from md2latex import MarkdownToLatex, ParsedDocument, TARGETS, convert_concurrently
+
+STAGES = ('_headings', '_lists', '_quotes', '_footnotes', '_emphasise', '_references')
+MIXES = {
+	'default': {'paragraph': 4, 'emphasis': 2, 'footnote': 1, 'heading': 1, 'list': 1, 'wrapped': 1, 'citation': 2, 'image': 1, 'link': 1, 'quote': 1},
+	'lists': {'paragraph': 1, 'list': 4, 'wrapped': 4},
+	'emphasis': {'paragraph': 1, 'emphasis': 6},
+	'references': {'paragraph': 1, 'citation': 6, 'link': 2},
+	'images': {'paragraph': 1, 'image': 4},
+	'code': {'paragraph': 1, 'code': 4},
+	'fields': {'paragraph': 2, 'emphasis': 2, 'footnote': 1, 'citation': 1, 'image': 1, 'link': 1, 'quote': 1},
+}
+ADVERSARIAL = {
+	'asterisks': lambda size: '*' * size,
+	'unclosed bold': lambda size: '**' + 'a*' * (size // 2),
+	'alternating': lambda size: '*_' * (size // 2),
+	'unclosed openers': lambda size: '*_**__' * (size // 6),
+	'backticks': lambda size: '`\\' * (size // 2),
+	'escapes': lambda size: '\\*' * (size // 2),
+}
+WORDS = ('lorem', 'ipsum', 'dolor', 'sit', 'amet', 'consectetur', 'adipiscing', 'elit', 'sed', 'do', 'eiusmod', 'tempor', 'incididunt', 'ut', 'labore', 'et', 'dolore', 'magna', 'aliqua')
+
+def _sentence(rng, length=12):
+	"""_sentence makes up a sentence of plain words"""
+	return ' '.join(rng.choice(WORDS) for _ in range(length)).capitalize() + '.'
+
+def _emphasised(rng):
+	"""_emphasised makes up a sentence where every few words are emphasised, bolded or monospaced"""
+	words = []
+	for _ in range(16):
+		word = rng.choice(WORDS)
+		markup = rng.randrange(6)
+		if markup == 0:
+			word = '*%s*' % word
+		elif markup == 1:
+			word = '**%s**' % word
+		elif markup == 2:
+			word = '_%s_' % word
+		elif markup == 3:
+			word = '`%s`' % word
+		words.append(word)
+	return ' '.join(words) + '.'
+
+def _block(feature, rng, counter, definitions):
+	"""_block makes up a block of Markdown showing off a single feature, adding the definitions it needs"""
+	if feature == 'paragraph':
+		return ' '.join(_sentence(rng) for _ in range(rng.randint(2, 6)))
+	if feature == 'footnote':
+		return '%s^(%s) %s' % (_sentence(rng), _sentence(rng, 6), _sentence(rng))
+	if feature == 'emphasis':
+		return ' '.join(_emphasised(rng) for _ in range(rng.randint(2, 6)))
+	if feature == 'heading':
+		if rng.randrange(2):
+			return '#' * rng.randint(1, 4) + ' ' + _sentence(rng, 4)
+		title = _sentence(rng, 4)
+		return title + '\n' + rng.choice('=-') * len(title)
+	if feature == 'list':
+		lines = []
+		for index in range(rng.randint(5, 30)):
+			depth = min(index % 6, rng.randint(0, 5))
+			lines.append('    ' * depth + rng.choice(('*', '-', '+', '%d.' % (index + 1))) + ' ' + _sentence(rng, 6))
+		return '\n'.join(lines)
+	if feature == 'wrapped':
+		lines = []
+		for _ in range(rng.randint(2, 6)):
+			lines.append('* ' + _sentence(rng, 8))
+			for line in range(rng.randint(10, 60)):
+				lines.append(('\t' if line % 2 else '    ') + _sentence(rng, 8))
+		return '\n'.join(lines)
+	if feature == 'citation':
+		sentences = []
+		for _ in range(rng.randint(2, 5)):
+			counter[0] += 1
+			ref = 'ref%d' % counter[0]
+			definitions.append('[%s]: "Author, %s %s" "%s" "%s"' % (ref, _sentence(rng, 6), counter[0], _sentence(rng, 5), _sentence(rng, 2)))
+			sentences.append('%s ^[%s][].' % (_sentence(rng, 8)[:-1], ref))
+		return ' '.join(sentences)
+	if feature == 'image':
+		counter[0] += 1
+		if rng.randrange(2):
+			return '%s ![image](./images/image%d.png "%s")' % (_sentence(rng), counter[0], _sentence(rng, 4))
+		definitions.append('[image%d]: ./images/image%d.png "%s"' % (counter[0], counter[0], _sentence(rng, 4)))
+		return '%s ![image%d][]' % (_sentence(rng), counter[0])
+	if feature == 'link':
+		counter[0] += 1
+		definitions.append('[site%d]: <www.example%d.com> "%s"' % (counter[0], counter[0], _sentence(rng, 2)))
+		return '%s [%s](http://example.org/%d) and [site%d][].' % (_sentence(rng), rng.choice(WORDS), counter[0], counter[0])
+	if feature == 'code':
+		lines = ['#include <%s_%s.h>' % (rng.choice(WORDS), rng.choice(WORDS))]
+		for _ in range(rng.randint(5, 40)):
+			lines.append('%s_%s = *%s_%s; // [%s]' % tuple(rng.choice(WORDS) for _ in range(5)))
+		if rng.randrange(2):
+			return '\n'.join(['```c'] + lines + ['```'])
+		return '\n'.join('    ' + line for line in lines)
+	if feature == 'quote':
+		return '\n'.join('> ' + _sentence(rng) for _ in range(rng.randint(1, 5)))
+	raise ValueError("unknown feature '%s'" % feature)
+
+def generate_corpus(size, mix='default', seed=0):
+	"""generate_corpus makes up a Markdown document of about size bytes with blocks picked according to mix
+
+	mix is either the name of one of the MIXES or a dictionary of features and their weights.
+	"""
+	if isinstance(mix, str):
+		mix = MIXES[mix]
+	rng = random.Random(seed)
+	features = sorted(mix)
+	weights = [mix[feature] for feature in features]
+	counter = [0]
+	definitions = []
+	blocks = ['# ' + _sentence(rng, 4)]
+	length = len(blocks[0])
+	while length < size:
+		known = len(definitions)
+		blocks.append(_block(rng.choices(features, weights)[0], rng, counter, definitions))
+		length += len(blocks[-1]) + 2 + sum(len(definition) + 1 for definition in definitions[known:])
+	return '\n\n'.join(blocks) + '\n\n' + '\n'.join(definitions)
+
+def _measure(function, text, repeat):
+	"""_measure times the fastest of repeat calls of function on text, then measures its peak memory in a separate call"""
+	best = None
+	for _ in range(repeat):
+		start = time.perf_counter()
+		result = function(text)
+		elapsed = time.perf_counter() - start
+		best = elapsed if best is None else min(best, elapsed)
+	tracemalloc.start()
+	function(text)
+	peak = tracemalloc.get_traced_memory()[1]
+	tracemalloc.stop()
+	megabytes = len(text.encode('utf-8')) / 1024 / 1024
+	return {'seconds': best, 'mb_per_s': megabytes / best if best else float('inf'), 'peak_bytes': peak}, result
+
+def run(text, repeat=3):
+	"""run benchmarks markdownify with either engine, rendering a parsed document for another target and every stage of the legacy pipeline on text
+
+	Each stage gets the output of the one before it, as it would in markdownify, starting with the code blocks taken out.
+	"""
+	results = {}
+	results['markdownify'] = _measure(MarkdownToLatex().markdownify, text, repeat)[0]
+	results['markdownify[single_pass]'] = _measure(MarkdownToLatex(single_pass=True).markdownify, text, repeat)[0]
+	parsed = MarkdownToLatex().parse(text).dumps()
+	results['render[parsed]'] = _measure(lambda text: ParsedDocument.loads(parsed).render(TARGETS['article']), text, repeat)[0]
+	converter = MarkdownToLatex()
+	results['_protect'], text = _measure(lambda text: '\n'.join(converter._protect(text.splitlines(), [])), text, repeat)
+	for stage in STAGES:
+		results[stage], text = _measure(getattr(converter, stage), text, repeat)
+	return results
+
+def adversarial(sizes=(16384, 32768, 65536, 131072), repeat=3):
+	"""adversarial times _emphasise on single lines of the ADVERSARIAL shapes as they double in size
+
+	The growth of a shape is the average ratio between the times of two consecutive sizes, about 2 if it takes linear time
+	and about 4 if it takes quadratic time.
+	"""
+	converter = MarkdownToLatex()
+	results = {}
+	for name, shape in ADVERSARIAL.items():
+		seconds = [_measure(converter._emphasise, shape(size), repeat)[0]['seconds'] for size in sizes]
+		results[name] = {'seconds': seconds, 'growth': (seconds[-1] / seconds[0]) ** (1 / (len(sizes) - 1))}
+	return results
+
+def snippets(count, mix='default', seed=0):
+	"""snippets makes up count short Markdown texts of a single block each, along with the definitions it needs"""
+	if isinstance(mix, str):
+		mix = MIXES[mix]
+	rng = random.Random(seed)
+	features = sorted(mix)
+	weights = [mix[feature] for feature in features]
+	counter = [0]
+	texts = []
+	for _ in range(count):
+		definitions = []
+		block = _block(rng.choices(features, weights)[0], rng, counter, definitions)
+		texts.append('\n'.join([block] + definitions))
+	return texts
+
+def many(texts, repeat=3):
+	"""many times converting every one of texts with a converter of its own against a single markdownify_many call"""
+	results = {}
+	for name, function in (('markdownify per text', lambda texts: [MarkdownToLatex().markdownify(text) for text in texts]), ('markdownify_many', MarkdownToLatex().markdownify_many)):
+		best = None
+		for _ in range(repeat):
+			start = time.perf_counter()
+			function(texts)
+			elapsed = time.perf_counter() - start
+			best = elapsed if best is None else min(best, elapsed)
+		results[name] = best
+	return results
+
+def threads(counts=(1, 2, 4), documents=32, size=32768, repeat=3):
+	"""threads times convert_concurrently on documents corpora of about size bytes with every number of threads in counts
+
+	The speedup of a number of threads is against the first of counts. It only grows past 1 on a free-threaded build.
+	"""
+	texts = [generate_corpus(size, seed=seed) for seed in range(documents)]
+	converter = MarkdownToLatex()
+	results = {}
+	for count in counts:
+		best = None
+		for _ in range(repeat):
+			start = time.perf_counter()
+			convert_concurrently(texts, count, converter)
+			elapsed = time.perf_counter() - start
+			best = elapsed if best is None else min(best, elapsed)
+		results[count] = {'seconds': best, 'speedup': results[counts[0]]['seconds'] / best if results else 1.0}
+	return results
+
+def compare(results, baseline, tolerance=0.25):
+	"""compare lists the measurements in results that are more than tolerance worse than those in baseline"""
+	regressions = []
+	for name, measured in sorted(results.items()):
+		if name not in baseline:
+			continue
+		if measured['mb_per_s'] < baseline[name]['mb_per_s'] * (1 - tolerance):
+			regressions.append('%s: %.2f MB/s, baseline %.2f MB/s' % (name, measured['mb_per_s'], baseline[name]['mb_per_s']))
+		if measured['peak_bytes'] > baseline[name]['peak_bytes'] * (1 + tolerance):
+			regressions.append('%s: %d bytes peak, baseline %d bytes' % (name, measured['peak_bytes'], baseline[name]['peak_bytes']))
+	return regressions
+
+def _parse_mix(mix):
+	"""_parse_mix reads a mix given as either a name or a list of feature=weight pairs"""
+	if mix in MIXES:
+		return mix
+	return dict((feature, float(weight)) for feature, weight in (pair.split('=') for pair in mix.split(',')))
+
+if __name__ == "__main__":
+	PARSER = argparse.ArgumentParser(description='Benchmarks md2latex on a synthetic Markdown corpus.')
+	PARSER.add_argument('-s', '--size', help='Size of the generated corpus in kilobytes.', required=False, type=int, default=256)
+	PARSER.add_argument('-m', '--mix', help='Blocks the corpus is made of, either one of %s or a list like list=3,emphasis=1 of the features %s.' % (', '.join(sorted(MIXES)), ', '.join(sorted(MIXES['default']))), required=False, default='default')
+	PARSER.add_argument('--seed', help='Seed of the corpus generator.', required=False, type=int, default=0)
+	PARSER.add_argument('-r', '--repeat', help='Number of timed runs, the fastest of which counts.', required=False, type=int, default=3)
+	PARSER.add_argument('--save', help='File the results are written to as a JSON baseline.', required=False, default='')
+	PARSER.add_argument('--baseline', help='JSON baseline the results are compared against. Any regression makes the run fail.', required=False, default='')
+	PARSER.add_argument('--tolerance', help='Fraction by which a result may be worse than the baseline.', required=False, type=float, default=0.25)
+	PARSER.add_argument('--adversarial', help='Time _emphasise on lines made to trip up backtracking instead, failing if it takes more than linear time.', required=False, action='store_true')
+	PARSER.add_argument('--many', help='Time converting this many texts of a single block each, one by one and with markdownify_many, instead. Use it with -m fields for short texts.', required=False, type=int, default=0)
+	PARSER.add_argument('--threads', help='Time convert_concurrently with each of a list of numbers of threads like 1,2,4 instead.', required=False, default='')
+	PARSER.add_argument('--corpus', help='File the generated corpus is written to, for inspection or profiling.', required=False, default='')
+	ARGS = vars(PARSER.parse_args())
+	if ARGS['adversarial']:
+		RESULTS = adversarial(repeat=ARGS['repeat'])
+		print('%-26s %10s %s' % ('shape', 'growth', 'seconds'))
+		for NAME, MEASURED in RESULTS.items():
+			print('%-26s %10.2f %s' % (NAME, MEASURED['growth'], ' '.join('%.4f' % SECONDS for SECONDS in MEASURED['seconds'])))
+		if any(MEASURED['growth'] > 3 for MEASURED in RESULTS.values()):
+			sys.exit(1)
+		sys.exit(0)
+	if ARGS['threads']:
+		RESULTS = threads([int(COUNT) for COUNT in ARGS['threads'].split(',')], size=ARGS['size'] * 1024 // 8, repeat=ARGS['repeat'])
+		print('GIL enabled: %s' % ('no' if not getattr(sys, '_is_gil_enabled', lambda: True)() else 'yes'))
+		print('%-26s %10s %10s' % ('threads', 'seconds', 'speedup'))
+		for COUNT, MEASURED in RESULTS.items():
+			print('%-26d %10.4f %10.2f' % (COUNT, MEASURED['seconds'], MEASURED['speedup']))
+		sys.exit(0)
+	if ARGS['many']:
+		RESULTS = many(snippets(ARGS['many'], _parse_mix(ARGS['mix']), ARGS['seed']), ARGS['repeat'])
+		for NAME, SECONDS in RESULTS.items():
+			print('%-26s %10.4f' % (NAME, SECONDS))
+		sys.exit(0)
+	CORPUS = {'size': ARGS['size'], 'mix': _parse_mix(ARGS['mix']), 'seed': ARGS['seed']}
+	TEXT = generate_corpus(ARGS['size'] * 1024, CORPUS['mix'], ARGS['seed'])
+	if ARGS['corpus']:
+		with open(ARGS['corpus'], 'w') as f:
+			f.write(TEXT)
+	RESULTS = run(TEXT, ARGS['repeat'])
+	print('%-26s %10s %10s %14s' % ('benchmark', 'seconds', 'MB/s', 'peak bytes'))
+	for NAME, MEASURED in RESULTS.items():
+		print('%-26s %10.4f %10.2f %14d' % (NAME, MEASURED['seconds'], MEASURED['mb_per_s'], MEASURED['peak_bytes']))
+	if ARGS['save']:
+		with open(ARGS['save'], 'w') as f:
+			json.dump({'corpus': CORPUS, 'results': RESULTS}, f, indent='\t')
+	if ARGS['baseline']:
+		with open(ARGS['baseline']) as f:
+			BASELINE = json.load(f)
+		if BASELINE['corpus'] != CORPUS:
+			print("Baseline '%s' was measured on a different corpus: %s" % (ARGS['baseline'], BASELINE['corpus']))
+			sys.exit(2)
+		REGRESSIONS = compare(RESULTS, BASELINE['results'], ARGS['tolerance'])
+		for REGRESSION in REGRESSIONS:
+			print('Regression in ' + REGRESSION)
+		if REGRESSIONS:
+			sys.exit(1)
@@ -3,6 +3,29 @@
 import re
 import argparse
 import os.path
+import stat
+import sys
+import glob
+import hashlib
+import marshal
+import sqlite3
+import time
+import json
+import mmap
+import struct
+import asyncio
+import multiprocessing
+import threading
+from array import array
+from collections import ChainMap, deque
+from contextlib import contextmanager
+from itertools import islice
+from http import HTTPStatus
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+try:
+	import resource
+except ImportError:
+	resource = None
 
 def _atx(matches):
 	"""_atx takes care of ATX-style headings"""
@@ -17,6 +40,135 @@ def _atx(matches):
 	else:
 		return "\\subsubsection{" + title + "}"
 
+HEADINGS = ('chapter', 'section', 'subsection', 'subsubsection')
+PLACEHOLDER = re.compile('\x00(?P<index>[0-9]+)\x00')
+PROTECTED = re.compile('\x01(?P<index>[0-9]+)\x01')
+SEPARATOR = '\x01-\x01'
+FENCE = re.compile(r'(?P<fence>`{3,}|~{3,})\s*(?P<language>[^`\s]*)\s*$')
+
+def _underline(line):
+	"""_underline returns the heading level a Setext-style underline stands for, or None"""
+	if line and line[0] in '=-' and not line.strip(line[0]):
+		return 1 if line[0] == '=' else 2
+	return None
+
+def _nest(levels, indent, environment):
+	"""_nest updates the stack of open lists for an item indented by indent, returning the lists it closes and the one it opens
+
+	An item indented deeper than the list it is in opens a nested one, an item indented less closes the nested lists it
+	is outside of, and one indented less than the outermost list stays in it.
+	"""
+	closed = []
+	while len(levels) > 1 and indent < levels[-1][0]:
+		closed.append(levels.pop()[1])
+	if not levels or indent > levels[-1][0]:
+		levels.append([indent, environment])
+		return closed, environment
+	if indent < levels[-1][0]:
+		levels[-1][0] = indent
+	return closed, None
+
+def _closes(line, fence):
+	"""_closes tells whether a line closes the code block opened by fence, being a run of at least as many of its characters"""
+	line = line.rstrip()
+	return len(line) >= len(fence) and not line.strip(fence[0])
+
+def _blocks(nodes, size=64):
+	"""_blocks groups block nodes into runs ending at a blank line or heading, so an edit only touches the run it is in"""
+	block = []
+	for node in nodes:
+		if block and (node[0] == 'heading' or len(block) >= size):
+			yield block
+			block = []
+		block.append(node)
+		if node[2].endswith('\\\\') or node[3].endswith('\\\\'):
+			yield block
+			block = []
+	if block:
+		yield block
+
+def _chunks(lines, size):
+	"""_chunks splits lines into runs of at least size characters, each starting at a line the tokenizer takes up afresh
+
+	That is a heading, list item or line of text that is not indented, does not underline the line before it and is not
+	inside a fenced code block, so nothing but the outermost list or a quote can carry over from one run into the next.
+	"""
+	chunk = []
+	length = 0
+	fence = None
+	for line in lines:
+		if fence is None and length >= size and line and not line[0].isspace() and _underline(line) is None:
+			yield chunk
+			chunk = []
+			length = 0
+		if fence is not None:
+			if _closes(line, fence):
+				fence = None
+		elif line.startswith(('```', '~~~')):
+			opening = FENCE.match(line)
+			fence = opening and opening.group('fence')
+		chunk.append(line)
+		length += len(line) + 1
+	if chunk:
+		yield chunk
+
+def _join_chunks(chunks):
+	"""_join_chunks joins the nodes rendered for consecutive chunks, continuing a list one of them leaves open into the next"""
+	output = []
+	last = None
+	for nodes in chunks:
+		environment = None
+		depth = 0
+		for index, (kind, arg, latex) in enumerate(nodes):
+			if index == 0 and kind == 'begin' and last and last[0] == 'end' and (arg == 'quote') == (last[1] == 'quote'):
+				output.pop()
+				environment = last[1]
+				continue
+			if environment and kind == 'begin':
+				depth += 1
+			elif environment and kind == 'end':
+				if not depth:
+					arg, latex = environment, '\\end{%s}' % environment
+					environment = None
+				depth -= 1
+			output.append(latex)
+			last = (kind, arg)
+	return '\n'.join(output)
+
+_VERSION = None
+
+def _version():
+	"""_version fingerprints the source of the converter, so cached conversions are dropped whenever it changes"""
+	global _VERSION
+	if _VERSION is None:
+		with open(__file__, 'rb') as source:
+			_VERSION = hashlib.sha256(source.read()).hexdigest()
+	return _VERSION
+
+@contextmanager
+def _replacing(path, mode='w'):
+	"""_replacing opens a file next to path to be written in its place, which replaces path only once it is written in full
+
+	Whoever reads or maps path meanwhile keeps seeing the old file, and a write that fails leaves path as it was. The
+	new file keeps the mode of the old one. Anything but a regular file or a path that does not exist yet, such as a
+	symbolic link or a device, or a path in a directory that cannot be written to, is written to directly instead.
+	"""
+	if os.path.islink(path) or os.path.exists(path) and not os.path.isfile(path) or not os.access(os.path.dirname(path) or '.', os.W_OK):
+		with open(path, mode) as new_file:
+			yield new_file
+		return
+	temporary = '%s.%d.%d.tmp' % (path, os.getpid(), threading.get_ident())
+	try:
+		with open(temporary, mode) as new_file:
+			yield new_file
+		if os.path.exists(path):
+			os.chmod(temporary, stat.S_IMODE(os.stat(path).st_mode))
+		os.replace(temporary, path)
+	except BaseException:
+		if os.path.exists(temporary):
+			os.remove(temporary)
+		raise
+
 def _inline_image(matches):
 	"""_inline_image takes care of images"""
 	result = '\\begin{figure}\n'
@@ -26,73 +178,777 @@ def _inline_image(matches):
 	result += '\\end{figure}'
 	return result
 
-class MarkdownToLatex:
-	"""MarkdownToLatex provides the means to convert Markdown-documents to LaTeX"""
+class ConversionCache:
+	"""ConversionCache keeps converted documents and blocks in an SQLite database keyed by the hash of their content
+
+	Once the entries take up more than max_size bytes the least recently used ones are evicted. Threads can share a
+	cache, taking turns on its connection.
+	"""
+	def __init__(self, path, max_size=256 * 1024 * 1024):
+		self.max_size = max_size
+		self.version = _version()
+		self.lock = threading.Lock()
+		self.connection = sqlite3.connect(path, timeout=60, check_same_thread=False)
+		self.connection.execute('CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY KEY, value TEXT, size INTEGER, used REAL)')
+		self.connection.execute('CREATE INDEX IF NOT EXISTS entries_used ON entries (used)')
+
+	def key(self, *parts):
+		"""key hashes the parts an entry depends on together with the converter version"""
+		digest = hashlib.sha256(self.version.encode())
+		for part in parts:
+			digest.update(b'\0' + str(part).encode('utf-8', 'surrogatepass'))
+		return digest.hexdigest()
+
+	def get(self, key):
+		"""get returns the entry stored under key, or None"""
+		with self.lock:
+			row = self.connection.execute('SELECT value FROM entries WHERE key = ?', (key,)).fetchone()
+			if row is None:
+				return None
+			self.connection.execute('UPDATE entries SET used = ? WHERE key = ?', (time.time(), key))
+			return row[0]
+
+	def put(self, key, value):
+		"""put stores value under key"""
+		with self.lock:
+			self.connection.execute('INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?)', (key, value, len(value), time.time()))
+
+	def commit(self):
+		"""commit evicts the least recently used entries past max_size and writes the changes to disk"""
+		with self.lock:
+			size = self.connection.execute('SELECT TOTAL(size) FROM entries').fetchone()[0]
+			if size > self.max_size:
+				for key, entry_size in self.connection.execute('SELECT key, size FROM entries ORDER BY used').fetchall():
+					self.connection.execute('DELETE FROM entries WHERE key = ?', (key,))
+					size -= entry_size
+					if size <= self.max_size:
+						break
+			self.connection.commit()
+
+class _StoreView:
+	"""_StoreView looks up one kind of definition in a ReferenceStore like a dictionary, decoding every entry only once"""
+	def __init__(self, store, kind):
+		self.store = store
+		self.kind = kind
+		self.decoded = {}
+
+	def __getitem__(self, ref):
+		if ref not in self.decoded:
+			fields = self.store.find(self.kind, ref)
+			if fields is None:
+				raise KeyError(ref)
+			if self.kind == 'b':
+				self.decoded[ref] = {'bib': fields[0], 'long': fields[1], 'short': fields[2]}
+			else:
+				self.decoded[ref] = tuple(fields)
+		return self.decoded[ref]
+
+	def __contains__(self, ref):
+		return self.get(ref) is not None
+
+	def get(self, ref, default=None):
+		try:
+			return self[ref]
+		except KeyError:
+			return default
+
+class ReferenceStore:
+	"""ReferenceStore holds bibliography and URL definitions shared by many documents in an indexed binary form
+
+	The binary form holds the number of entries, a digest of them, an array of offsets and the entries themselves,
+	sorted by kind and reference. It is what save writes to disk and what load maps back into memory, so a store is
+	ready without parsing anything. Definitions are found by binary search and decoded when they are first used.
+	"""
+	MAGIC = b'md2latex references\n'
+
+	def __init__(self, buffer):
+		if bytes(buffer[:len(self.MAGIC)]) != self.MAGIC:
+			raise ValueError('not a reference store')
+		start = len(self.MAGIC)
+		self.count, = struct.unpack_from('<Q', buffer, start)
+		self.digest = bytes(buffer[start + 8:start + 40]).hex()
+		start += 40
+		self.offsets = memoryview(buffer)[start:start + 8 * (self.count + 1)].cast('Q')
+		if sys.byteorder != 'little':
+			self.offsets = array('Q', self.offsets)
+			self.offsets.byteswap()
+		self.base = start + 8 * (self.count + 1)
+		self.buffer = buffer
+		self.path = None
+		self.bibliography = _StoreView(self, 'b')
+		self.urls = _StoreView(self, 'u')
+
+	@classmethod
+	def build(cls, bibliography, urls):
+		"""build makes a store of the bibliography and URL definitions given as dictionaries"""
+		records = [(b'b', ref.encode('utf-8'), '\x1f'.join((entry['bib'], entry['long'], entry['short'])).encode('utf-8')) for ref, entry in bibliography.items()]
+		records += [(b'u', ref.encode('utf-8'), '\x1f'.join(entry).encode('utf-8')) for ref, entry in urls.items()]
+		records.sort()
+		data = b''.join(kind + b'\x1f' + ref + b'\x1f' + fields for kind, ref, fields in records)
+		offsets = array('Q', [0])
+		for kind, ref, fields in records:
+			offsets.append(offsets[-1] + len(kind) + len(ref) + len(fields) + 2)
+		if sys.byteorder != 'little':
+			offsets.byteswap()
+		header = cls.MAGIC + struct.pack('<Q', len(records)) + hashlib.sha256(data).digest()
+		return cls(header + offsets.tobytes() + data)
+
+	@classmethod
+	def parse(cls, path):
+		"""parse makes a store of the definitions in a Markdown file"""
+		with open(path) as definitions_file:
+			return cls.build(*MarkdownToLatex().scan_definitions(definitions_file))
+
+	@classmethod
+	def load(cls, path):
+		"""load maps a store written by save into memory"""
+		with open(path, 'rb') as store_file:
+			store = cls(mmap.mmap(store_file.fileno(), 0, access=mmap.ACCESS_READ))
+		store.path = path
+		return store
+
+	@classmethod
+	def open(cls, path):
+		"""open loads a store, or the definitions in a Markdown file through a store saved next to it as path.idx, which is rebuilt whenever the file changes"""
+		with open(path, 'rb') as store_file:
+			if store_file.read(len(cls.MAGIC)) == cls.MAGIC:
+				return cls.load(path)
+		index = path + '.idx'
+		if not os.path.exists(index) or os.path.getmtime(index) < os.path.getmtime(path):
+			cls.parse(path).save(index)
+		return cls.load(index)
+
+	def save(self, path):
+		"""save writes the store to disk, replacing the file at path so that stores already mapping it keep working"""
+		with _replacing(path, 'wb') as store_file:
+			store_file.write(self.buffer)
+
+	def find(self, kind, ref):
+		"""find returns the fields of the definition of ref of the given kind, 'b' for bibliography or 'u' for URL, or None"""
+		key = [kind.encode(), ref.encode('utf-8')]
+		low = 0
+		high = self.count
+		while low < high:
+			middle = (low + high) // 2
+			record = bytes(self.buffer[self.base + self.offsets[middle]:self.base + self.offsets[middle + 1]]).split(b'\x1f')
+			if record[:2] < key:
+				low = middle + 1
+			elif record[:2] > key:
+				high = middle
+			else:
+				return [field.decode('utf-8') for field in record[2:]]
+		return None
+
+class MappedLines:
+	"""MappedLines maps a file into memory and reads it as a sequence of lines, decoding each line only when it is read
+
+	The offsets at which lines start are indexed once, so every pass over the lines shares the index instead of
+	splitting the text again, and the file is never held in memory as a whole. Lines end where str.splitlines ends
+	them, at \\n, \\r\\n, \\r, form feeds and the other Unicode line breaks, and come without their line ending. Where
+	the system allows it, the pages of the file are let go of once they have been read through, so they do not add up
+	in the memory of the process. Reading a file that has been truncated since it was mapped kills the process with
+	SIGBUS, so files that may be saved meanwhile, such as the ones ProjectWatcher watches, have to be read as usual.
+	"""
+	RELEASE = 16 * 1024 * 1024
+	LINE_BREAK = re.compile(b'\r\n|[\n\r\x0b\x0c\x1c-\x1e]|\xc2\x85|\xe2\x80[\xa8\xa9]')
+
+	def __init__(self, path):
+		with open(path, 'rb') as md_file:
+			size = os.fstat(md_file.fileno()).st_size
+			self.buffer = mmap.mmap(md_file.fileno(), 0, access=mmap.ACCESS_READ) if size else b''
+		self.offsets = array('Q', [0])
+		released = 0
+		for matches in self.LINE_BREAK.finditer(self.buffer):
+			position = matches.end()
+			self.offsets.append(position)
+			if position - released >= self.RELEASE:
+				released = self._release(released, position)
+		if self.offsets[-1] != size:
+			self.offsets.append(size)
+		self._release(released, size)
+
+	def __len__(self):
+		return len(self.offsets) - 1
+
+	def __getitem__(self, index):
+		if not -len(self) <= index < len(self):
+			raise IndexError('line index out of range')
+		index %= len(self)
+		return self.buffer[self.offsets[index]:self.offsets[index + 1]].decode('utf-8').splitlines()[0]
+
+	def __iter__(self):
+		buffer = self.buffer
+		start = 0
+		released = 0
+		for end in islice(self.offsets, 1, None):
+			yield buffer[start:end].decode('utf-8').splitlines()[0]
+			start = end
+			if start - released >= self.RELEASE:
+				released = self._release(released, start)
+		self._release(released, start)
+
+	def _release(self, start, end):
+		"""_release lets go of the pages of the file between start and end, returning where the released pages end"""
+		end -= end % mmap.PAGESIZE
+		if end > start and hasattr(self.buffer, 'madvise') and hasattr(mmap, 'MADV_DONTNEED'):
+			self.buffer.madvise(mmap.MADV_DONTNEED, start, end - start)
+		return end
+
+	def close(self):
+		"""close unmaps the file"""
+		if self.buffer:
+			self.buffer.close()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *exc_info):
+		self.close()
+
+class Target:
+	"""Target tells the single pass engine how to render headings, figures and links for a kind of document
+
+	heading_offset shifts headings down, so that with 1 a # heading becomes a section. figure is the environment images
+	are put in, or None for a bare includegraphics without a caption. href is how links are rendered: 'href' makes them
+	hyperlinks, 'url' prints their address instead and 'footnote' puts the address in a footnote.
+	"""
+	HEADINGS = HEADINGS + ('paragraph', 'subparagraph')
+
+	def __init__(self, heading_offset=0, figure='figure', href='href'):
+		if href not in ('href', 'url', 'footnote'):
+			raise ValueError("unknown link style '%s'" % href)
+		self.heading_offset = heading_offset
+		self.figure = figure
+		self.href = href
+
+	def __repr__(self):
+		return 'Target(%r, %r, %r)' % (self.heading_offset, self.figure, self.href)
+
+	def reference(self, record):
+		"""reference renders a resolved reference, either ('text', latex), ('figure', address, caption) or ('href', address, text)"""
+		if record[0] == 'text':
+			return record[1]
+		if record[0] == 'figure':
+			if not self.figure:
+				return '\\includegraphics{%s}' % record[1]
+			result = '\\begin{%s}\n\\includegraphics{%s}\n' % (self.figure, record[1])
+			if record[2]:
+				result += '\\caption{%s}\n' % record[2]
+			return result + '\\end{%s}' % self.figure
+		if self.href == 'url':
+			return '\\url{%s}' % record[1]
+		if self.href == 'footnote':
+			return '%s\\footnote{\\url{%s}}' % (record[2], record[1])
+		return '\\href{%s}{%s}' % (record[1], record[2])
+
+	def restore(self, text, records):
+		"""restore puts the rendered references back in place of the placeholders in text"""
+		if not records:
+			return text
+		return PLACEHOLDER.sub(lambda m: self.reference(records[int(m.group('index'))]), text)
+
+	def code(self, language, code):
+		"""code renders a code block, in a lstlisting environment if it names its language and in a verbatim one otherwise"""
+		if language:
+			return '\\begin{lstlisting}[language=%s]\n%s\n\\end{lstlisting}' % (language, code)
+		return '\\begin{verbatim}\n%s\n\\end{verbatim}' % code
+
+	def node(self, kind, arg, text, tail):
+		"""node renders a block node whose text and tail have been rendered already
+
+		The text of a code node is the language of the code on its first line, followed by the code itself.
+		"""
+		if kind == 'text':
+			return text
+		elif kind == 'item':
+			return '\\item ' + text
+		elif kind == 'heading':
+			return '\\%s{%s}%s' % (self.HEADINGS[min(arg - 1 + self.heading_offset, len(self.HEADINGS) - 1)], text, tail)
+		elif kind == 'code':
+			return self.code(*text.split('\n', 1)) + tail
+		elif kind == 'begin':
+			return '\\begin{%s}' % arg
+		else:
+			return '\\end{%s}' % arg
+
+TARGETS = {'book': Target(), 'article': Target(1), 'beamer': Target(1, None)}
+
+class ParsedDocument:
+	"""ParsedDocument is a document parsed by the single pass engine, which renders it for any Target without parsing it again
+
+	Its inline markup is rendered already, except for the references, which are kept as records in place of the
+	placeholders in the text. Node kinds and arguments are kept in arrays, and dumps packs everything with marshal.
+	"""
+	KINDS = ('text', 'item', 'heading', 'begin', 'end', 'code')
+	ENVIRONMENTS = ('itemize', 'enumerate', 'quote')
+
+	def __init__(self, kinds=None, args=None, parts=None, records=None):
+		self.kinds = kinds if kinds is not None else array('B')
+		self.args = args if args is not None else array('B')
+		self.parts = parts if parts is not None else []
+		self.records = records if records is not None else []
+
+	def __len__(self):
+		return len(self.kinds)
+
+	def append(self, kind, arg, text, tail):
+		"""append adds a node given its kind and argument and its text and tail, each along with their reference records"""
+		self.kinds.append(self.KINDS.index(kind))
+		self.args.append(self.ENVIRONMENTS.index(arg) if kind in ('begin', 'end') else arg or 0)
+		self.parts.extend((text[0], tail[0]))
+		self.records.extend((text[1], tail[1]))
+
+	def extend(self, document):
+		"""extend adds the nodes of another document"""
+		self.kinds.extend(document.kinds)
+		self.args.extend(document.args)
+		self.parts.extend(document.parts)
+		self.records.extend(document.records)
+
+	def chunks(self, target=None):
+		"""chunks yields the LaTeX of every node as rendered for target, the book target by default"""
+		target = target or TARGETS['book']
+		for index, kind in enumerate(self.kinds):
+			kind = self.KINDS[kind]
+			arg = self.ENVIRONMENTS[self.args[index]] if kind in ('begin', 'end') else self.args[index]
+			text = target.restore(self.parts[2 * index], self.records[2 * index])
+			tail = target.restore(self.parts[2 * index + 1], self.records[2 * index + 1])
+			yield target.node(kind, arg, text, tail)
+
+	def render(self, target=None):
+		"""render renders the document for target, the book target by default"""
+		return '\n'.join(self.chunks(target))
+
+	def dumps(self):
+		"""dumps packs the document into bytes, tagged with the version of the converter"""
+		return marshal.dumps((_version(), self.kinds.tobytes(), self.args.tobytes(), self.parts, self.records))
+
+	@classmethod
+	def loads(cls, data):
+		"""loads unpacks a document packed by dumps, raising ValueError if another version of the converter packed it"""
+		version, kinds, args, parts, records = marshal.loads(data)
+		if version != _version():
+			raise ValueError('parsed by another version of md2latex')
+		return cls(array('B', kinds), array('B', args), parts, records)
+
+	def save(self, path):
+		"""save writes the packed document to disk"""
+		with open(path, 'wb') as ir_file:
+			ir_file.write(self.dumps())
+
+	@classmethod
+	def load(cls, path):
+		"""load reads a document written by save"""
+		with open(path, 'rb') as ir_file:
+			return cls.loads(ir_file.read())
+
+class Template:
+	"""Template is a template parsed once into literal segments and named slots such as %BODY%, %TITLE% and %BIBLIOGRAPHY%"""
+	SLOT = re.compile('%([A-Z]+)%')
+	_compiled = {}
+
+	def __init__(self, text):
+		self.segments = self.SLOT.split(text)
+		self.slots = self.segments[1::2]
+
+	@classmethod
+	def load(cls, path):
+		"""load returns the compiled template of a file, compiling it again only when the file has changed since"""
+		stat = os.stat(path)
+		compiled = cls._compiled.get(path)
+		if compiled is None or compiled[0] != (stat.st_mtime_ns, stat.st_size):
+			with open(path) as temp_file:
+				compiled = ((stat.st_mtime_ns, stat.st_size), cls(temp_file.read()))
+			cls._compiled[path] = compiled
+		return compiled[1]
+
+	def chunks(self, values):
+		"""chunks yields the template chunk by chunk with its slots filled in from values
+
+		A value is either a string or an iterable of strings, such as the output of markdownify_stream, which is passed
+		on as it comes. Slots without a value are left as they are.
+		"""
+		for index, segment in enumerate(self.segments):
+			if not index % 2:
+				if segment:
+					yield segment
+			elif segment not in values:
+				yield '%' + segment + '%'
+			elif isinstance(values[segment], str):
+				yield values[segment]
+			else:
+				yield from values[segment]
+
+	def write(self, output, values):
+		"""write writes the template with its slots filled in to a file or stream"""
+		output.writelines(self.chunks(values))
+
+	def render(self, values):
+		"""render returns the template with its slots filled in"""
+		return ''.join(self.chunks(values))
+
+STAGES = ('_headings', '_lists', '_footnotes', '_emphasise', '_references', '_quotes', '_render_node', '_resolvable', 'scan_definitions')
+
+def _size(value):
+	"""_size returns the number of bytes of a string or of the text of a block node"""
+	if isinstance(value, str):
+		return len(value.encode('utf-8', 'surrogatepass'))
+	if isinstance(value, tuple):
+		return sum(_size(text) for text in value[2:])
+	return 0
+
+def _counting(lines, counts):
+	"""_counting passes on the input lines, adding up their bytes and number in counts"""
+	for line in lines:
+		counts[0] += _size(line)
+		counts[1] += 1
+		yield line
+
+class _CountingPattern:
+	"""_CountingPattern stands in for a compiled pattern while profiling, counting its searches and matches"""
+	def __init__(self, pattern, stats):
+		self.pattern = pattern
+		self.stats = stats
+
+	def __getattr__(self, name):
+		return getattr(self.pattern, name)
+
+	def search(self, string, *args):
+		matches = self.pattern.search(string, *args)
+		self.stats.count(1, matches is not None)
+		return matches
+
+	def match(self, string, *args):
+		matches = self.pattern.match(string, *args)
+		self.stats.count(1, matches is not None)
+		return matches
+
+	def sub(self, repl, string, count=0):
+		result, matched = self.pattern.subn(repl, string, count)
+		self.stats.count(1, matched)
+		return result
+
+	def finditer(self, string, *args):
+		self.stats.count(1, 0)
+		for matches in self.pattern.finditer(string, *args):
+			self.stats.count(0, 1)
+			yield matches
+
+class ConversionStats:
+	"""ConversionStats records the calls, wall time, bytes in and out, lines and regular expression searches and matches of every stage of a conversion
+
+	Pass it to MarkdownToLatex to have it filled in. The time of a stage called from within another, such as _emphasise
+	from _render_node, is part of the time of both. Conversions running in several threads add up in the same totals,
+	each keeping track of the stage it is in.
+	"""
 	def __init__(self):
-		self.emph = re.compile(r'((?<!\\)[\*_])(?P<text>[^\\].*?)(\1)')
-		self.bold = re.compile(r'((\\{0}[\*_]){2})(?P<text>.+?)\1')
-		self.monospace = re.compile('`(?P<text>.+?)`')
-		self.chapter = re.compile('(?P<title>.+)\n=+', re.MULTILINE)
-		self.section = re.compile(r'(?P<title>.+)\n\-+$', re.MULTILINE)
-		self.atx = re.compile('(?P<hashes>#+)(?P<title>.+)')
-		self.unordered = re.compile(r'^\s*([\+\-\*])\s+(?P<text>.+)')
-		self.ordered = re.compile(r'^\s*([1-9]+[0-9]*)\.\s+(?P<text>.+)')
-		self.footnote = re.compile(r'\^\((?P<text>.+)\)')
-		self.citation = re.compile(r'\[(?P<ref>\S+?)\]:\s+"(?P<bib>.+?)"\s+"(?P<long>.+?)"\s+"(?P<short>.+?)"')
-		self.url = re.compile(r'\[(?P<ref>\S+?)\]:\s+\<?(?P<url>\S+?)\>?\s+"(?P<desc>.+?)"')
-		self.inline_reference = re.compile(r'(?P<image>\!)?\[(?P<alt>.+?)\]\s*\((?P<address>.+?)\s*(?:"(?P<title>.+?)")?\)')
-		self.reference = re.compile(r'(?P<type>[\^\!])?\[(?P<ref>.+?)\]\[(?P<id>.*?)\]')
-		self.quote = re.compile(r'\s*>\s+(?P<text>.+)')
+		self.stages = {}
+		self.lock = threading.Lock()
+		self.local = threading.local()
+
+	@property
+	def current(self):
+		"""current is the stage running in the calling thread, or None"""
+		return getattr(self.local, 'current', None)
+
+	@current.setter
+	def current(self, stage):
+		self.local.current = stage
+
+	def add(self, stage, seconds=0.0, bytes_in=0, bytes_out=0, lines=0, calls=1):
+		"""add adds a measurement to the totals of a stage"""
+		with self.lock:
+			if stage not in self.stages:
+				self.stages[stage] = {'calls': 0, 'seconds': 0.0, 'bytes_in': 0, 'bytes_out': 0, 'lines': 0, 'searches': 0, 'matches': 0}
+			totals = self.stages[stage]
+			totals['calls'] += calls
+			totals['seconds'] += seconds
+			totals['bytes_in'] += bytes_in
+			totals['bytes_out'] += bytes_out
+			totals['lines'] += lines
+
+	def count(self, searches, matches):
+		"""count adds regular expression searches and matches to the stage that is running"""
+		stage = self.current or 'other'
+		self.add(stage, calls=0)
+		with self.lock:
+			self.stages[stage]['searches'] += searches
+			self.stages[stage]['matches'] += matches
+
+	def wrap(self, stage, function):
+		"""wrap returns a version of function that is recorded as stage"""
+		def profiled(*args):
+			value = args[0]
+			counts = [0, 0]
+			if not isinstance(value, (str, tuple)):
+				args = (_counting(value, counts),) + args[1:]
+			outer, self.current = self.current, stage
+			start = time.perf_counter()
+			try:
+				result = function(*args)
+			finally:
+				self.current = outer
+			if isinstance(value, str):
+				size, lines = _size(value), value.count('\n') + 1
+			elif isinstance(value, tuple):
+				size, lines = _size(value), 1
+			else:
+				size, lines = counts
+			self.add(stage, time.perf_counter() - start, size, _size(result), lines)
+			return result
+		return profiled
+
+	def wrap_generator(self, stage, function):
+		"""wrap_generator returns a version of a generator function taking lines that is recorded as stage"""
+		def counted(lines):
+			for line in lines:
+				self.add(stage, bytes_in=_size(line), lines=1, calls=0)
+				yield line
+		def profiled(lines, *args):
+			self.add(stage)
+			generator = function(counted(lines), *args)
+			while True:
+				outer, self.current = self.current, stage
+				start = time.perf_counter()
+				try:
+					value = next(generator)
+				except StopIteration:
+					return
+				finally:
+					self.current = outer
+					self.add(stage, time.perf_counter() - start, calls=0)
+				self.add(stage, bytes_out=_size(value), calls=0)
+				yield value
+		return profiled
+
+	def report(self):
+		"""report formats the stats as a table"""
+		rows = ['%-14s %8s %10s %12s %12s %10s %10s %10s %8s' % ('stage', 'calls', 'seconds', 'bytes in', 'bytes out', 'lines', 'searches', 'matches', 'per line')]
+		for stage, totals in self.stages.items():
+			per_line = totals['searches'] / totals['lines'] if totals['lines'] else 0
+			rows.append('%-14s %8d %10.4f %12d %12d %10d %10d %10d %8.2f' % (stage, totals['calls'], totals['seconds'], totals['bytes_in'], totals['bytes_out'], totals['lines'], totals['searches'], totals['matches'], per_line))
+		return '\n'.join(rows)
+
+class MarkdownToLatex:
+	"""MarkdownToLatex provides the means to convert Markdown-documents to LaTeX
+
+	A converter keeps nothing of a document once it is converted: its patterns are compiled once for the class and
+	whatever a conversion keeps track of, such as the definitions and the citations made so far, is local to the call.
+	Threads can therefore share one converter, along with its cache, stats and reference store. The legacy pipeline
+	only renders for book, so a converter given any other target converts with the single pass engine.
+	"""
+	emphasis = re.compile(r'[\*_\\`](?:(?<=\*)\**|(?<=_)_*|(?<=\\)[\*_\\`]|(?<=`)(?P<code>[^`\n]+)`)')
+	chapter = re.compile('\n=+')
+	section = re.compile(r'\n\-+$', re.MULTILINE)
+	atx = re.compile('(?P<hashes>##*)(?P<title>.+)')
+	footnote = re.compile(r'\^\((?P<text>.+)\)')
+	citation = re.compile(r'\[(?P<ref>\S+?)\]:\s+"(?P<bib>.+?)"\s+"(?P<long>.+?)"\s+"(?P<short>.+?)"')
+	url = re.compile(r'\[(?P<ref>\S+?)\]:\s+\<?(?P<url>\S+?)\>?\s+"(?P<desc>.+?)"')
+	inline_reference = re.compile(r'(?P<image>\!)?\[(?P<alt>.+?)\]\s*\((?P<address>.+?)\s*(?:"(?P<title>.+?)")?\)')
+	reference = re.compile(r'(?P<type>[\^\!])?\[(?P<ref>.+?)\]\[(?P<id>.*?)\]')
+	quote = re.compile(r'\s*>\s+(?P<text>.+)')
+	item = re.compile(r'(?P<indent>\s*)(?:[\+\-\*]|(?P<number>[1-9][0-9]*)\.)\s+(?P<text>.+)')
+	inline = re.compile(r'(?P<type>[\^\!])?\[(?P<ref>[^\]]+)\](?:\[(?P<id>[^\]]*)\]|\s*\((?P<address>[^\)]+?)\s*(?:"(?P<title>[^"]+)")?\))')
+
+	def __init__(self, single_pass=False, cache=None, stats=None, references=None, jobs=1, target=None):
+		self.target = target or TARGETS['book']
+		self.single_pass = single_pass or repr(self.target) != repr(TARGETS['book'])
+		self.jobs = jobs
+		self.cache = cache
+		self.stats = stats
+		self.references = references
+		if stats is not None:
+			for name, value in vars(MarkdownToLatex).items():
+				if isinstance(value, re.Pattern):
+					setattr(self, name, _CountingPattern(value, stats))
+			for stage in STAGES:
+				setattr(self, stage, stats.wrap(stage, getattr(self, stage)))
+			self._tokenize = stats.wrap_generator('_tokenize', self._tokenize)
+			self._protect = stats.wrap_generator('_protect', self._protect)
 
 	def _emphasise(self, text):
-		"""_emphasise takes care of emphasis and bolding"""
-		text = self.bold.sub(lambda m: "\\textbf{%s}" % m.group('text'), text)
-		text = self.emph.sub(lambda m: "\\emph{%s}" % m.group('text'), text)
-		text = self.monospace.sub(lambda m: "\\texttt{%s}" % m.group('text'), text)
-		return text
+		"""_emphasise takes care of emphasis, bolding and monospace in a single pass over text
+
+		Runs of * or _ are kept on a stack of openers until a run of the same kind closes them, which drops the openers
+		in between as plain text. Delimiters don't pair across lines, escaped ones are left alone and code spans are
+		taken literally. Every token is looked at once and every opener popped at most once, so it takes linear time.
+		"""
+		if '*' not in text and '_' not in text and '`' not in text:
+			return text
+		result = []
+		openers = []
+		counts = dict.fromkeys(((char, size) for char in '*_' for size in (1, 2)), 0)
+		position = 0
+		for token in self.emphasis.finditer(text):
+			if openers and text.find('\n', position, token.start()) != -1:
+				openers.clear()
+				counts = dict.fromkeys(counts, 0)
+			result.append(text[position:token.start()])
+			position = token.end()
+			if token.lastgroup == 'code':
+				result.append('\\texttt{%s}' % token.group('code'))
+				continue
+			delimiter = token.group()
+			char = delimiter[0]
+			if char == '\\':
+				result.append(delimiter)
+				continue
+			if len(delimiter) < 3:
+				sizes = (len(delimiter),)
+			elif counts[char, 1] or counts[char, 2]:
+				sizes = (1, 2)
+			else:
+				sizes = (2, 1)
+			for size in sizes:
+				if counts[char, size]:
+					while True:
+						opener = openers.pop()
+						counts[opener[:2]] -= 1
+						if opener[:2] == (char, size):
+							break
+					result[opener[2]] = '\\emph{' if size == 1 else '\\textbf{'
+					result.append('}')
+				else:
+					counts[char, size] += 1
+					openers.append((char, size, len(result)))
+					result.append(char * size)
+			result.append(delimiter[3:])
+		result.append(text[position:])
+		return ''.join(result)
+
+	def _protect(self, lines, regions):
+		"""_protect yields the input lines with every code block replaced by a placeholder line, indexing the code in regions
+
+		A code block is either fenced by lines of three or more backticks or tildes, the first of which may name its
+		language, or indented by a tab or four spaces after a blank line outside of a list. Every later stage only sees
+		the placeholder, so the code is neither converted nor scanned again. regions gets a (language, code) pair for
+		every placeholder, whose index it holds. The \\x00 and \\x01 characters placeholders are made of are dropped
+		from the input, so nothing in it is taken for a placeholder.
+		"""
+		fence = None
+		code = None
+		blanks = 0
+		listing = False
+		blank = True
+		for line in lines:
+			if '\x00' in line or '\x01' in line:
+				line = line.replace('\x00', '').replace('\x01', '')
+			if fence is not None:
+				if _closes(line, fence):
+					regions.append((language, '\n'.join(code)))
+					yield '\x01%d\x01' % (len(regions) - 1)
+					fence = code = None
+					listing = blank = False
+				else:
+					code.append(line)
+				continue
+			if code is not None:
+				if not line:
+					blanks += 1
+					continue
+				if line.startswith('\t') or line.startswith('    '):
+					code.extend([''] * blanks)
+					code.append(line[1:] if line.startswith('\t') else line[4:])
+					blanks = 0
+					continue
+				regions.append(('', '\n'.join(code)))
+				yield '\x01%d\x01' % (len(regions) - 1)
+				for _ in range(blanks):
+					yield ''
+				code = None
+				blank = blanks > 0
+				blanks = 0
+			if line.startswith(('```', '~~~')):
+				opening = FENCE.match(line)
+				if opening:
+					fence, language, code = opening.group('fence'), opening.group('language'), []
+					continue
+			if blank and not listing and (line.startswith('\t') or line.startswith('    ')) and line.strip():
+				code = [line[1:] if line.startswith('\t') else line[4:]]
+				language = ''
+				continue
+			stripped = line.lstrip()
+			if stripped and stripped[0] in '+-*123456789' and self.item.match(line):
+				listing = True
+			elif line and not line[0].isspace():
+				listing = False
+			blank = not line
+			yield line
+		if code is not None:
+			regions.append((language, '\n'.join(code)))
+			yield '\x01%d\x01' % (len(regions) - 1)
+			for _ in range(blanks):
+				yield ''
+
+	def _unprotect(self, text, regions):
+		"""_unprotect puts the code blocks _protect took out of the text back in place of their placeholders"""
+		if not regions:
+			return text
+		return PROTECTED.sub(lambda m: TARGETS['book'].code(*regions[int(m.group('index'))]), text)
+
+	def _underlined(self, text, underline, command):
+		"""_underlined turns every line of text followed by a match of underline into a heading
+
+		Only the underlines are searched for, and the line before each is found from there, so the text is scanned once.
+		Placeholders of code blocks are never taken for the title of a heading.
+		"""
+		result = []
+		position = 0
+		for matches in underline.finditer(text):
+			start = text.rfind('\n', 0, matches.start()) + 1
+			if start < position or start == matches.start() or text[start] == '\x01':
+				continue
+			result.append(text[position:start])
+			result.append('\\%s{%s}' % (command, text[start:matches.start()].strip()))
+			position = matches.end()
+		if not result:
+			return text
+		result.append(text[position:])
+		return ''.join(result)
 
 	def _headings(self, text):
 		"""_headings takes care of headings"""
-		text = self.chapter.sub(lambda m: "\\chapter{%s}" % m.group('title').strip(), text)
-		text = self.section.sub(lambda m: "\\section{%s}" % m.group('title').strip(), text)
+		text = self._underlined(text, self.chapter, 'chapter')
+		text = self._underlined(text, self.section, 'section')
 		text = self.atx.sub(_atx, text)
 		return text
 
 	def _lists(self, text):
-		"""_lists takes care of lists"""
+		"""_lists takes care of lists, nesting them by the indentation of their items
+
+		Every line is matched once and continuation lines are collected as fragments of the line they continue, which
+		are only joined at the end, so it takes linear time. Lines nothing is appended to are kept as they are.
+		"""
 		result = []
-		active_list = ""
-		begin = {'ordered': r'\begin{enumerate}', 'unordered': r'\begin{itemize}'}
-		end = {'ordered': r'\end{enumerate}', 'unordered': r'\end{itemize}'}
+		levels = []
 		for line in text.splitlines():
-			unordered = self.unordered.search(line)
-			ordered = self.ordered.search(line)
-			if unordered or ordered:
-				if not active_list:
-					if unordered:
-						active_list = 'unordered'
-					elif ordered:
-						active_list = 'ordered'
-					result.append(begin[active_list])
-				if unordered:
-					result.append(self.unordered.sub(lambda m: "\\item %s" % m.group('text').strip(), line))
-				elif ordered:
-					result.append(self.ordered.sub(lambda m: "\\item %s" % m.group('text').strip(), line))
-
-			elif line.startswith("\t"):
-				result[-1] += " " + line[1:]
-			elif line.startswith("    "):
-				result[-1] += line[3:]
-			elif line == "":
-				result[-1] += "\\\\"
+			item = self.item.match(line) if line[:1] in '+-*123456789' or line[:1].isspace() else None
+			if item:
+				closed, opened = _nest(levels, len(item.group('indent').expandtabs(4)), 'itemize' if item.group('number') is None else 'enumerate')
+				result.extend('\\end{%s}' % environment for environment in closed)
+				if opened:
+					result.append('\\begin{%s}' % opened)
+				result.append(['\\item ', item.group('text').strip()])
+			elif line.startswith("\t") or line.startswith("    ") or line == "":
+				if line.startswith("\t"):
+					fragment = " " + line[1:]
+				elif line:
+					fragment = line[3:]
+				else:
+					fragment = "\\\\"
+				if not result:
+					result.append([fragment])
+				elif isinstance(result[-1], str):
+					result[-1] = [result[-1], fragment]
+				else:
+					result[-1].append(fragment)
 			else:
-				if active_list:
-					result.append(end[active_list])
-				active_list = ""
+				if levels:
+					result.extend('\\end{%s}' % level[1] for level in reversed(levels))
+					levels = []
 				result.append(line)
-		if active_list:
-			result.append(end[active_list])
-		return '\n'.join(result)
+		result.extend('\\end{%s}' % level[1] for level in reversed(levels))
+		return '\n'.join(entry if isinstance(entry, str) else ''.join(entry) for entry in result)
 
 	def _footnotes(self, text):
 		"""_footnotes takes care of footnotes"""
@@ -106,9 +962,9 @@ class MarkdownToLatex:
 		#image = {}
 		lines = []
 		for line in text.splitlines():
-			citation = self.citation.search(line)
-			url = self.url.search(line)
-			inline_reference = self.inline_reference.search(line)
+			citation = self.citation.search(line) if ']:' in line else None
+			url = self.url.search(line) if ']:' in line and not citation else None
+			inline_reference = self.inline_reference.search(line) if '[' in line and not citation and not url else None
 			if citation:
 				if citation.group('ref') in bibliography.keys():
 					raise KeyError("Duplicate key '%s'" % citation.group('ref'))
@@ -125,48 +981,26 @@ class MarkdownToLatex:
 				else:
 					line = self.inline_reference.sub(lambda m: '\\href{%s}{%s}' % (m.group('address'), m.group('alt')), line)
 			lines.append(line)
+		bibliography, urls = self._with_store(bibliography, urls)
 		result = []
-		bib_tags = []
+		bib_tags = set()
 		for line in lines:
-			reference = self.reference.search(line)
-			if reference:
-				if reference.group('type'):
-					if reference.group('type') == '!':
-						if reference.group('ref') not in urls.keys():
-							raise KeyError("reference '%s' undefined" % reference.group('ref'))
-						line = self.reference.sub(r'\\begin{figure}\n\\includegraphics{%s}\n\\caption{%s}\n\\end{figure}' % urls[reference.group('ref')], line)
-					elif reference.group('type') == '^':
-						if reference.group('ref') not in bibliography.keys():
-							raise KeyError("reference '%s' undefined" % reference.group('ref'))
-						if reference.group('id'):
-							if reference.group('id') not in ('long', 'short', 'bib'):
-								raise KeyError("erroneus key '%s'" % reference.group('id'))
-							line = self.reference.sub(bibliography[reference.group('ref')][reference.group('id')], line)
-						else:
-							if reference.group('ref') not in bib_tags:
-								bib_tags.append(reference.group('ref'))
-								key = 'long'
-							else:
-								key = 'short'
-							line = self.reference.sub(bibliography[reference.group('ref')][key], line)
-				else:
-					if reference.group('ref') not in urls.keys():
-						raise KeyError("reference '%s' undefined" % reference.group('ref'))
-					line = self.reference.sub(r"\\href{%s}{%s}" % urls[reference.group('ref')], line)
+			if '][' in line:
+				line = self.reference.sub(lambda m: TARGETS['book'].reference(self._resolve(m.group('type'), m.group('ref'), m.group('id'), bibliography, urls, bib_tags)), line)
 			result.append(line)
 		return '\n'.join(result)
 
 	def _quotes(self, text):
-		"""_quotes taks care of quotation blocks"""
+		"""_quotes takes care of quotation blocks"""
 		results = []
 		active_block = False
 		for line in text.splitlines():
-			quote = self.quote.search(line)
+			quote = self.quote.match(line) if '>' in line else None
 			if quote:
 				if not active_block:
 					results.append('\\begin{quote}')
 					active_block = True
-				line = self.quote.sub(lambda m: m.group('text'), line)
+				line = quote.group('text')
 			else:
 				if active_block:
 					results.append('\\end{quote}')
@@ -176,55 +1010,972 @@ class MarkdownToLatex:
 			results.append('\\end{quote}')
 		return '\n'.join(results)
 
+	def _define(self, text, bibliography, urls):
+		"""_define registers the reference definitions found in text and returns whatever is left of it"""
+		if ']:' not in text:
+			return text
+		def citation(matches):
+			if matches.group('ref') in bibliography:
+				raise KeyError("Duplicate key '%s'" % matches.group('ref'))
+			bibliography[matches.group('ref')] = {'bib': matches.group('bib'), 'long': matches.group('long'), 'short': matches.group('short')}
+			return ''
+		def url(matches):
+			if matches.group('ref') in urls:
+				raise KeyError("Duplicate key '%s'" % matches.group('ref'))
+			urls[matches.group('ref')] = (matches.group('url'), matches.group('desc'))
+			return ''
+		text = self.citation.sub(citation, text)
+		return self.url.sub(url, text)
+
+	def _tokenize(self, lines, bibliography, urls):
+		"""_tokenize scans the input lines once and yields them as block nodes, registering reference definitions on the way"""
+		regions = []
+		levels = []
+		quoted = False
+		node = None
+		lines = iter(self._protect(lines, regions))
+		line = next(lines, None)
+		while line is not None:
+			following = next(lines, None)
+			if line.startswith('\x01'):
+				if node:
+					yield (node[0], node[1], ''.join(node[2]), ''.join(node[3]))
+				for environment in reversed(levels):
+					yield ('end', environment[1], '', '')
+				levels = []
+				if quoted:
+					yield ('end', 'quote', '', '')
+					quoted = False
+				node = ['code', None, ['%s\n%s' % regions[int(line[1:-1])]], []]
+				line = following
+				continue
+			level = _underline(following) if line else None
+			heading = self.atx.match(line) if not level and line.startswith('#') else None
+			if level or heading:
+				if node:
+					yield (node[0], node[1], ''.join(node[2]), ''.join(node[3]))
+				for environment in reversed(levels):
+					yield ('end', environment[1], '', '')
+				levels = []
+				if quoted:
+					yield ('end', 'quote', '', '')
+					quoted = False
+				if level:
+					title = line.strip()
+					following = next(lines, None)
+				else:
+					level = min(len(heading.group('hashes')), len(HEADINGS))
+					title = heading.group('title').replace('#', '').strip()
+				node = ['heading', level, [self._define(title, bibliography, urls)], []]
+			else:
+				item = self.item.match(line)
+				if item:
+					if node:
+						yield (node[0], node[1], ''.join(node[2]), ''.join(node[3]))
+					if quoted:
+						yield ('end', 'quote', '', '')
+						quoted = False
+					closed, opened = _nest(levels, len(item.group('indent').expandtabs(4)), 'itemize' if item.group('number') is None else 'enumerate')
+					for environment in closed:
+						yield ('end', environment, '', '')
+					if opened:
+						yield ('begin', opened, '', '')
+					node = ['item', None, [self._define(item.group('text').strip(), bibliography, urls)], []]
+				elif line.startswith('\t') or line.startswith('    ') or line == '':
+					if node is None:
+						node = ['text', None, [], []]
+					if line.startswith('\t'):
+						fragment = self._define(' ' + line[1:], bibliography, urls)
+					elif line:
+						fragment = self._define(line[3:], bibliography, urls)
+					else:
+						fragment = '\\\\'
+					node[3 if node[0] in ('heading', 'code') else 2].append(fragment)
+				else:
+					if node:
+						yield (node[0], node[1], ''.join(node[2]), ''.join(node[3]))
+					for environment in reversed(levels):
+						yield ('end', environment[1], '', '')
+					levels = []
+					quote = self.quote.match(line) if '>' in line else None
+					if quote and not quoted:
+						yield ('begin', 'quote', '', '')
+					elif quoted and not quote:
+						yield ('end', 'quote', '', '')
+					quoted = bool(quote)
+					node = ['text', None, [self._define(quote.group('text') if quote else line, bibliography, urls)], []]
+			line = following
+		if node:
+			yield (node[0], node[1], ''.join(node[2]), ''.join(node[3]))
+		for environment in reversed(levels):
+			yield ('end', environment[1], '', '')
+		if quoted:
+			yield ('end', 'quote', '', '')
+
+	def _resolve(self, kind, ref, key, bibliography, urls, bib_tags, inline=None):
+		"""_resolve returns the record of the reference to a definition for Target.reference, rendering the text of the definition with inline if given"""
+		if kind == '^':
+			if ref not in bibliography:
+				raise KeyError("reference '%s' undefined" % ref)
+			if key:
+				if key not in ('long', 'short', 'bib'):
+					raise KeyError("erroneus key '%s'" % key)
+			elif ref in bib_tags:
+				key = 'short'
+			else:
+				bib_tags.add(ref)
+				key = 'long'
+			text = bibliography[ref][key]
+			return ('text', inline(text) if inline else text)
+		if ref not in urls:
+			raise KeyError("reference '%s' undefined" % ref)
+		address, description = urls[ref]
+		if inline:
+			description = inline(description)
+		return ('figure' if kind == '!' else 'href', address, description)
+
+	def _with_store(self, bibliography, urls):
+		"""_with_store falls back on the reference store, if there is one, for whatever the document does not define itself"""
+		if self.references is None:
+			return bibliography, urls
+		return ChainMap(bibliography, self.references.bibliography), ChainMap(urls, self.references.urls)
+
+	def _reference(self, matches, tokens, bibliography, urls, bib_tags):
+		"""_reference resolves a single link, image or reference into a record and leaves a placeholder in its stead"""
+		kind, ref = matches.group('type'), matches.group('ref')
+		prefix = ''
+		if matches.group('address') is not None:
+			if kind == '!':
+				title = matches.group('title')
+				record = ('figure', matches.group('address'), self._emphasise(title) if title else None)
+			else:
+				prefix = kind or ''
+				record = ('href', matches.group('address'), self._emphasise(ref))
+		else:
+			record = self._resolve(kind, ref, matches.group('id'), bibliography, urls, bib_tags, self._emphasise)
+		tokens.append(record)
+		return '%s\x00%d\x00' % (prefix, len(tokens) - 1)
+
+	def _parse_inline(self, text, bibliography, urls, bib_tags):
+		"""_parse_inline renders the inline markup of a single block node, returning it along with the records of its references"""
+		tokens = []
+		if not text:
+			return text, tokens
+		if '[' in text:
+			text = self.inline.sub(lambda m: self._reference(m, tokens, bibliography, urls, bib_tags), text)
+		if '^(' in text:
+			text = self._footnotes(text)
+		return self._emphasise(text), tokens
+
+	def _inline(self, text, bibliography, urls, bib_tags):
+		"""_inline renders the inline markup of a single block node"""
+		return self.target.restore(*self._parse_inline(text, bibliography, urls, bib_tags))
+
+	def _render_node(self, node, bibliography, urls, bib_tags):
+		"""_render_node renders a single block node to LaTeX"""
+		kind, arg, text, tail = node
+		if kind == 'code':
+			return self.target.node(kind, arg, text, tail)
+		return self.target.node(kind, arg, self._inline(text, bibliography, urls, bib_tags), self._inline(tail, bibliography, urls, bib_tags))
+
+	def _parse(self, nodes, bibliography, urls, bib_tags):
+		"""_parse renders the inline markup of block nodes into a ParsedDocument"""
+		document = ParsedDocument()
+		for kind, arg, text, tail in nodes:
+			if kind == 'code':
+				document.append(kind, arg, (text, []), (tail, []))
+			else:
+				document.append(kind, arg, self._parse_inline(text, bibliography, urls, bib_tags), self._parse_inline(tail, bibliography, urls, bib_tags))
+		return document
+
+	def parse(self, text):
+		"""parse parses the input text into a ParsedDocument, which renders it for any Target without parsing it again"""
+		bibliography = {}
+		urls = {}
+		nodes = list(self._tokenize(text.splitlines(), bibliography, urls))
+		return self._parse(nodes, *self._with_store(bibliography, urls), set())
+
+	def _render(self, nodes, bibliography, urls):
+		"""_render walks the block nodes once and yields the LaTeX for every one of them"""
+		bib_tags = set()
+		for node in nodes:
+			yield self._render_node(node, bibliography, urls, bib_tags)
+
+	def _references_in(self, node):
+		"""_references_in yields the references to definitions made in a block node"""
+		if node[0] == 'code':
+			return
+		for text in node[2:]:
+			if '][' not in text:
+				continue
+			for matches in self.inline.finditer(text):
+				if matches.group('id') is not None:
+					yield matches
+
+	def _resolvable(self, node, bibliography, urls):
+		"""_resolvable tells whether every reference in a block node has been defined yet"""
+		for matches in self._references_in(node):
+			if matches.group('ref') not in (bibliography if matches.group('type') == '^' else urls):
+				return False
+		return True
+
+	def _block_key(self, block, bibliography, urls, bib_tags):
+		"""_block_key hashes a block along with the definitions it uses and whether its citations come first"""
+		parts = [repr(block)]
+		cited = []
+		for node in block:
+			for matches in self._references_in(node):
+				ref = matches.group('ref')
+				if matches.group('type') != '^':
+					parts.append(repr(urls.get(ref)))
+					continue
+				parts.append(repr(bibliography.get(ref)))
+				if not matches.group('id'):
+					parts.append(ref in bib_tags or ref in cited)
+					cited.append(ref)
+		return self.cache.key('block', *parts), cited
+
+	def _cached(self, text, definitions=None):
+		"""_cached markdownifies the text, reusing whatever the cache holds of the document or of its blocks
+
+		Blocks are kept as parsed documents, so rendering the text for another target reuses them as well.
+		"""
+		store = self.references.digest if self.references else ''
+		if definitions:
+			key = self.cache.key('document', store, hashlib.sha256(marshal.dumps(definitions)).hexdigest(), repr(self.target), text)
+		else:
+			key = self.cache.key('document', store, self.single_pass, repr(self.target), text)
+		result = self.cache.get(key)
+		if result is not None:
+			self.cache.commit()
+			return result
+		if self.single_pass or definitions:
+			bibliography = {}
+			urls = {}
+			nodes = list(self._tokenize(text.splitlines(), bibliography, urls))
+			bibliography, urls = self._with_store(*(definitions or (bibliography, urls)))
+			bib_tags = set()
+			document = ParsedDocument()
+			for block in _blocks(nodes):
+				block_key, cited = self._block_key(block, bibliography, urls, bib_tags)
+				parsed = self.cache.get(block_key)
+				if parsed is None:
+					parsed = self._parse(block, bibliography, urls, bib_tags)
+					self.cache.put(block_key, parsed.dumps())
+				else:
+					parsed = ParsedDocument.loads(parsed)
+					bib_tags.update(cited)
+				document.extend(parsed)
+			result = document.render(self.target)
+		else:
+			result = self.markdownify(text)
+		self.cache.put(key, result)
+		self.cache.commit()
+		return result
+
+	def _single_pass(self, text):
+		"""_single_pass tokenizes the text once and renders it in a single walk"""
+		bibliography = {}
+		urls = {}
+		nodes = list(self._tokenize(text.splitlines(), bibliography, urls))
+		return '\n'.join(self._render(nodes, *self._with_store(bibliography, urls)))
+
+	def _parallel(self, text):
+		"""_parallel converts the text as _single_pass does, tokenizing and rendering chunks of it across a pool of processes
+
+		A first round collects the definitions of every chunk and the references it cites without a key, so that the
+		second one can resolve the references of a chunk as if all chunks before it had been converted already. Each
+		chunk is only sent the definitions it refers to.
+		"""
+		chunks = ['\n'.join(chunk) for chunk in _chunks(text.splitlines(), max(len(text) // (self.jobs * 4), 65536))]
+		if len(chunks) < 2:
+			return self._single_pass(text)
+		references = (self.references.path or bytes(self.references.buffer)) if self.references else None
+		with ProcessPoolExecutor(max_workers=self.jobs, initializer=_init_worker, initargs=(None, None, None, references, self.target)) as pool:
+			bibliography = {}
+			urls = {}
+			nodes = []
+			used = []
+			cited = [set()]
+			for chunk_nodes, chunk_bibliography, chunk_urls, chunk_used, chunk_cited in pool.map(_tokenize_chunk, chunks):
+				for ref in chunk_bibliography:
+					if ref in bibliography:
+						raise KeyError("Duplicate key '%s'" % ref)
+				for ref in chunk_urls:
+					if ref in urls:
+						raise KeyError("Duplicate key '%s'" % ref)
+				bibliography.update(chunk_bibliography)
+				urls.update(chunk_urls)
+				nodes.append(chunk_nodes)
+				used.append(chunk_used)
+				cited.append(cited[-1] | chunk_cited)
+			definitions = [(dict((ref, bibliography[ref]) for ref in refs[0] if ref in bibliography), dict((ref, urls[ref]) for ref in refs[1] if ref in urls)) for refs in used]
+			bib_tags = [cited[index] & refs[0] for index, refs in enumerate(used)]
+			return _join_chunks(pool.map(_render_chunk, nodes, definitions, bib_tags))
+
 	def markdownify(self, text):
-		"""markdownify markdownifies the input text"""
+		"""markdownify markdownifies the input text, spread across jobs processes if there is more than one"""
+		if self.jobs > 1:
+			return self._parallel(text)
+		if self.single_pass:
+			return self._single_pass(text)
+		regions = []
+		lines = list(self._protect(text.splitlines(), regions))
+		if regions or '\x00' in text or '\x01' in text:
+			# a text ending in a blank line has to keep it, or _lists would not see the list end there
+			text = '\n'.join(lines) + '\n' if lines[-1:] == [''] else '\n'.join(lines)
 		text = self._headings(text)
 		text = self._lists(text)
+		text = self._quotes(text)
 		text = self._footnotes(text)
 		text = self._emphasise(text)
 		text = self._references(text)
-		return text
+		return self._unprotect(text, regions)
+
+	def _markdownify_batch(self, texts):
+		"""_markdownify_batch markdownifies a list of texts with the legacy pipeline, running most stages once for all of them
+
+		The texts are joined with SEPARATOR lines, which end any heading, list or quote, and split apart again before
+		their references are resolved, so every text keeps its definitions to itself. Texts that cannot hold code or
+		references skip those stages.
+		"""
+		regions = []
+		lines = []
+		for text in texts:
+			if '```' in text or '~~~' in text or '\t' in text or '    ' in text or '\x00' in text or '\x01' in text:
+				lines.extend(self._protect(text.splitlines(), regions))
+			else:
+				lines.extend(text.splitlines())
+			lines.append(SEPARATOR)
+		text = '\n'.join(lines)
+		text = self._headings(text)
+		text = self._lists(text)
+		text = self._quotes(text)
+		text = self._footnotes(text)
+		text = self._emphasise(text)
+		results = []
+		for part in text.split(SEPARATOR)[:-1]:
+			if results and part.startswith('\n'):
+				part = part[1:]
+			if part.endswith('\n'):
+				part = part[:-1]
+			if '[' in part:
+				part = self._references(part)
+			results.append(self._unprotect(part, regions))
+		return results
+
+	def markdownify_many(self, texts, batch_size=1024):
+		"""markdownify_many markdownifies every text of an iterable, returning the results in order as markdownify would
+
+		The legacy pipeline converts batch_size texts at a time, so that its stages are not called once per text.
+		"""
+		if self.jobs > 1 or self.single_pass:
+			return [self.markdownify(text) for text in texts]
+		results = []
+		batch = []
+		for text in texts:
+			batch.append(text)
+			if len(batch) == batch_size:
+				results.extend(self._markdownify_batch(batch))
+				batch = []
+		if batch:
+			results.extend(self._markdownify_batch(batch))
+		return results
+
+	def scan_definitions(self, lines, definitions=None):
+		"""scan_definitions collects the reference definitions in the input lines without converting anything, adding them to definitions if given"""
+		bibliography, urls = definitions or ({}, {})
+		for line in self._protect((line.rstrip('\r\n') for line in lines), []):
+			self._define(line, bibliography, urls)
+		return bibliography, urls
+
+	def markdownify_stream(self, lines, definitions=None):
+		"""markdownify_stream markdownifies the input lines, yielding LaTeX chunks as it goes
+
+		Joined together the chunks are identical to the output of markdownify. References used before
+		their definition hold back the output from that point on until the definition turns up, unless
+		the definitions have been collected beforehand with scan_definitions.
+		"""
+		bibliography = {}
+		urls = {}
+		known = self._with_store(*(definitions or (bibliography, urls)))
+		bib_tags = set()
+		pending = deque()
+		separator = ''
+		for node in self._tokenize((line.rstrip('\r\n') for line in lines), bibliography, urls):
+			if pending or not self._resolvable(node, *known):
+				pending.append(node)
+				while pending and self._resolvable(pending[0], *known):
+					yield separator + self._render_node(pending.popleft(), known[0], known[1], bib_tags)
+					separator = '\n'
+			else:
+				yield separator + self._render_node(node, known[0], known[1], bib_tags)
+				separator = '\n'
+		for node in pending:
+			yield separator + self._render_node(node, known[0], known[1], bib_tags)
+			separator = '\n'
 
-	def markdown_file(self, file):
-		"""markdownFile markdownifies an input file"""
+	def markdown_file_stream(self, file):
+		"""markdown_file_stream markdownifies an input file chunk by chunk, scanning it for definitions first"""
+		with MappedLines(file) as lines:
+			yield from self.markdownify_stream(lines, self.scan_definitions(lines))
+
+	def markdown_file(self, file, definitions=None):
+		"""markdownFile markdownifies an input file, resolving references against definitions if given
+
+		Unless it goes through the cache or the legacy pipeline, the file is mapped into memory and converted line
+		by line rather than read in whole.
+		"""
+		if self.jobs == 1 and not self.cache and (self.single_pass or definitions):
+			with MappedLines(file) as lines:
+				return ''.join(self.markdownify_stream(lines, definitions or self.scan_definitions(lines)))
 		with open(file) as md_file:
 			markdown_text = md_file.read()
+		if self.cache:
+			return self._cached(markdown_text, definitions)
+		if definitions:
+			return ''.join(self.markdownify_stream(markdown_text.splitlines(), definitions))
 		return self.markdownify(markdown_text)
 #		return md
 
+	def _title(self, lines, bibliography, urls):
+		"""_title renders the text of the first heading in the input lines, reading no further than that"""
+		for node in self._tokenize((line.rstrip('\r\n') for line in lines), {}, {}):
+			if node[0] == 'heading':
+				return self._inline(node[2], bibliography, urls, set())
+		return ''
+
+	def markdown_template_stream(self, markdown_file, template, definitions=None):
+		"""markdown_template_stream converts a Markdown-file and yields it chunk by chunk as part of a template file
+
+		The %BODY% of the template is filled in with the document, %TITLE% with its first heading and %BIBLIOGRAPHY%
+		with a thebibliography environment of the bibliography entries it defines. References are resolved against
+		definitions if given, such as the definitions of every file of a project, and otherwise against its own.
+		"""
+		with MappedLines(markdown_file) as lines:
+			yield from self._template_stream(lines, markdown_file, template, definitions)
+
+	def _template_stream(self, lines, markdown_file, template, definitions=None):
+		"""_template_stream fills in a template with the document in lines, which has been read from markdown_file"""
+		template = Template.load(template)
+		own = self.scan_definitions(lines)
+		resolved = definitions or own
+		values = {'BIBLIOGRAPHY': ''}
+		if own[0]:
+			items = ''.join('\\bibitem{%s} %s\n' % (ref, self._emphasise(entry['bib'])) for ref, entry in own[0].items())
+			values['BIBLIOGRAPHY'] = '\\begin{thebibliography}{%d}\n%s\\end{thebibliography}' % (len(own[0]), items)
+		if 'TITLE' in template.slots:
+			values['TITLE'] = self._title(lines, *self._with_store(*resolved))
+		if self.cache or self.jobs > 1 or not self.single_pass:
+			values['BODY'] = self.markdown_file(markdown_file, definitions)
+		else:
+			values['BODY'] = self.markdownify_stream(lines, resolved)
+		yield from template.chunks(values)
+
 	def markdown_template(self, markdown_file, template):
 		"""markdownWithTemplate converts a Markdown-file to LaTeX and embeds it into a template file"""
-		with open(template) as temp_file:
-			temp = temp_file.read()
-		markdown_text = self.markdown_file(markdown_file)
-		rep = r'%BODY%'
-		print(rep)
-		temp = temp.replace(rep, markdown_text)
-		return temp
+		return ''.join(self.markdown_template_stream(markdown_file, template))
+
+_CONVERTER = None
+_DEFINITIONS = None
+
+def _init_worker(definitions, cache=None, cache_size=None, references=None, target=None):
+	"""_init_worker sets up the converter and the shared definitions of a worker process
+
+	references is the path of a saved ReferenceStore or the binary form of one.
+	"""
+	global _CONVERTER, _DEFINITIONS
+	if isinstance(references, bytes):
+		references = ReferenceStore(references)
+	elif references:
+		references = ReferenceStore.load(references)
+	_CONVERTER = MarkdownToLatex(single_pass=True, cache=ConversionCache(cache, cache_size) if cache else None, references=references, target=target)
+	_DEFINITIONS = definitions
+
+def _tokenize_chunk(text):
+	"""_tokenize_chunk tokenizes a chunk of a document
+
+	Returns its nodes, its definitions, the citations and URLs it refers to and the citations it makes without a key.
+	"""
+	bibliography = {}
+	urls = {}
+	used = (set(), set())
+	cited = set()
+	nodes = list(_CONVERTER._tokenize(text.split('\n'), bibliography, urls))
+	for node in nodes:
+		for matches in _CONVERTER._references_in(node):
+			if matches.group('type') != '^':
+				used[1].add(matches.group('ref'))
+				continue
+			used[0].add(matches.group('ref'))
+			if not matches.group('id'):
+				cited.add(matches.group('ref'))
+	return nodes, bibliography, urls, used, cited
+
+def _render_chunk(nodes, definitions, bib_tags):
+	"""_render_chunk renders the nodes of a chunk of a document, given the definitions of all of it and the citations made before the chunk"""
+	bibliography, urls = _CONVERTER._with_store(*definitions)
+	return [(node[0], node[1], _CONVERTER._render_node(node, bibliography, urls, bib_tags)) for node in nodes]
+
+def _convert_file(source, target):
+	"""_convert_file converts a single file of a project, streaming it to its target unless it goes through the cache"""
+	if _CONVERTER.cache:
+		output = _CONVERTER.markdown_file(source, _DEFINITIONS)
+		with open(target, 'w') as tex_file:
+			tex_file.write(output)
+		return target
+	with open(source) as md_file, open(target, 'w') as tex_file:
+		tex_file.writelines(_CONVERTER.markdownify_stream(md_file, _DEFINITIONS))
+	return target
+
+def project_files(spec):
+	"""project_files lists the Markdown files of a project given as a directory, a manifest file or a glob pattern"""
+	if os.path.isdir(spec):
+		return sorted(glob.glob(os.path.join(spec, '*.md')))
+	if os.path.isfile(spec):
+		with open(spec) as manifest:
+			names = [line.strip() for line in manifest if line.strip() and not line.startswith('#')]
+		return [os.path.join(os.path.dirname(spec), name) for name in names]
+	return sorted(glob.glob(spec))
+
+def _targets(files, output_dir=None):
+	"""_targets names the .tex file every file of a project is converted into, next to it or in output_dir"""
+	return [os.path.join(output_dir or os.path.dirname(file), os.path.splitext(os.path.basename(file))[0] + '.tex') for file in files]
+
+def markdown_project(files, jobs=None, output_dir=None, cache=None, cache_size=256 * 1024 * 1024, references=None, target=None):
+	"""markdown_project converts every file of a project to a .tex file of the same name across a pool of processes
+
+	The reference definitions of all files are collected up front and shared by every file, so chapters can refer
+	to definitions made in another chapter. If cache is the path of a ConversionCache database, unchanged files and
+	blocks are taken from it. references is the path of a ReferenceStore, or of a Markdown file of definitions, whose
+	definitions every file falls back on; each process maps the same store. target is the Target the files are
+	rendered for. Returns the paths of the generated files in the order of the input.
+	"""
+	definitions = ({}, {})
+	converter = MarkdownToLatex()
+	for file in files:
+		with open(file) as md_file:
+			converter.scan_definitions(md_file, definitions)
+	targets = _targets(files, output_dir)
+	if references:
+		references = ReferenceStore.open(references).path
+	if jobs == 1:
+		_init_worker(definitions, cache, cache_size, references, target)
+		return [_convert_file(source, target) for source, target in zip(files, targets)]
+	with ProcessPoolExecutor(max_workers=jobs, initializer=_init_worker, initargs=(definitions, cache, cache_size, references, target)) as pool:
+		return list(pool.map(_convert_file, files, targets))
+
+def convert_concurrently(docs, threads=None, converter=None):
+	"""convert_concurrently markdownifies every text of docs across a pool of threads sharing one converter, returning the results in order
+
+	converter is the MarkdownToLatex to share, a default one if not given; texts go through its cache if it has one.
+	Threads only convert side by side on a free-threaded build of Python, but unlike the processes of markdown_project
+	they share the memory of a single converter and its reference store either way.
+	"""
+	converter = converter or MarkdownToLatex()
+	convert = converter._cached if converter.cache else converter.markdownify
+	with ThreadPoolExecutor(max_workers=threads) as pool:
+		return list(pool.map(convert, docs))
+
+def _concatenate(files, size=1024 * 1024):
+	"""_concatenate yields the contents of files one after the other, separated by a newline, in pieces of at most size characters"""
+	for index, file in enumerate(files):
+		if index:
+			yield '\n'
+		with open(file) as tex_file:
+			yield from iter(lambda: tex_file.read(size), '')
+
+def assemble(template, files, output):
+	"""assemble writes the generated files of a project, in order, into the %BODY% of a template"""
+	Template.load(template).write(output, {'BODY': _concatenate(files)})
+
+class ProjectWatcher:
+	"""ProjectWatcher keeps the files of a project converted while they are edited, converting only what a change affects
+
+	Every file is converted into the target of the same index. If output is given, a path or an open file, the targets
+	are assembled into the %BODY% of the template there; otherwise every file is put into the template on its own, if
+	there is one. A target is only replaced once it has been converted in full. The definitions of all files are shared as in markdown_project, and references is the path of a
+	file of definitions they fall back on. A changed file is converted again along with the files that use a definition
+	it added, changed or removed. A changed references file has the files that use one of its changed definitions
+	converted again, and a changed template has the project assembled again. The converter is kept for every rebuild.
+	"""
+	def __init__(self, files, targets, references=None, template=None, output=None, target=None):
+		self.files = list(files)
+		self.targets = dict(zip(self.files, targets))
+		self.references = references
+		self.template = template
+		self.output = output
+		self.converter = MarkdownToLatex(single_pass=True, references=ReferenceStore.open(references) if references else None, target=target)
+		self.definitions = {}
+		self.used = {}
+		self.stamps = {}
+		self.pending = set()
+		self.poll()
+
+	def _stamp(self, path):
+		"""_stamp returns the modification time and size of a file, or None while it does not exist"""
+		try:
+			status = os.stat(path)
+		except OSError:
+			return None
+		return (status.st_mtime_ns, status.st_size)
+
+	def _scan(self, file):
+		"""_scan collects the definitions a file makes and the definitions it uses, as ('b', ref) or ('u', ref) pairs"""
+		with open(file) as md_file:
+			lines = [line.rstrip('\r\n') for line in md_file]
+		self.definitions[file] = self.converter.scan_definitions(lines)
+		used = set()
+		for line in self.converter._protect(lines, []):
+			if '][' in line:
+				used.update(('b' if matches.group('type') == '^' else 'u', matches.group('ref')) for matches in self.converter._references_in(('text', None, line, '')))
+		self.used[file] = used
+
+	def _shared(self):
+		"""_shared merges the definitions of every file, which may not define the same reference twice"""
+		bibliography = {}
+		urls = {}
+		for file in self.files:
+			for shared, own in zip((bibliography, urls), self.definitions[file]):
+				for ref in own:
+					if ref in shared:
+						raise KeyError("Duplicate key '%s'" % ref)
+				shared.update(own)
+		return bibliography, urls
+
+	def _stored(self, key):
+		"""_stored looks up a ('b', ref) or ('u', ref) definition in the reference store"""
+		kind, ref = key
+		return (self.converter.references.bibliography if kind == 'b' else self.converter.references.urls).get(ref)
+
+	def poll(self):
+		"""poll returns the watched files that changed since the last poll"""
+		changed = set()
+		for path in self.files + [path for path in (self.references, self.template) if path]:
+			stamp = self._stamp(path)
+			if stamp is not None and stamp != self.stamps.get(path):
+				self.stamps[path] = stamp
+				changed.add(path)
+		return changed
+
+	def rebuild(self, changed):
+		"""rebuild converts whatever the changed files affect again, returning the files it converted"""
+		affected = set(self.pending)
+		definitions = {}
+		if self.references in changed:
+			# the old store may map the index that opening the new one rewrites, so read it first
+			old = {key: self._stored(key) for used in self.used.values() for key in used}
+			self.converter.references = ReferenceStore.open(self.references)
+			definitions.update((key, True) for key, entry in old.items() if self._stored(key) != entry)
+		for file in self.files:
+			if file not in changed and file in self.definitions:
+				continue
+			before = self.definitions.get(file, ({}, {}))
+			self._scan(file)
+			for kind, old, new in zip('bu', before, self.definitions[file]):
+				definitions.update(((kind, ref), True) for ref in set(old) | set(new) if old.get(ref) != new.get(ref))
+			affected.add(file)
+		for file, used in self.used.items():
+			if not used.isdisjoint(definitions):
+				affected.add(file)
+		if self.template in changed and not self.output:
+			affected.update(self.files)
+		# whatever a failed rebuild left unconverted is converted by the next one
+		self.pending = affected
+		shared = self._shared()
+		converted = [file for file in self.files if file in affected]
+		for file in converted:
+			# files being edited may be truncated under a mapping, which would crash the watch, so they are read instead
+			with open(file) as md_file:
+				lines = [line.rstrip('\r\n') for line in md_file]
+			with _replacing(self.targets[file]) as tex_file:
+				if self.template and not self.output:
+					tex_file.writelines(self.converter._template_stream(lines, file, self.template, shared))
+				else:
+					tex_file.writelines(self.converter.markdownify_stream(lines, shared))
+		if self.output and self.template and (converted or self.template in changed):
+			if isinstance(self.output, str):
+				with _replacing(self.output) as output:
+					assemble(self.template, [self.targets[file] for file in self.files], output)
+			else:
+				assemble(self.template, [self.targets[file] for file in self.files], self.output)
+				self.output.flush()
+		self.pending = set()
+		return converted
+
+	def watch(self, interval=0.5, debounce=0.2, report=None):
+		"""watch converts the whole project, then polls it every interval seconds and rebuilds it once changes have settled for debounce seconds
+
+		report is called with the files converted by every rebuild and the seconds it took, or with the error that stopped it.
+		"""
+		changed = set(self.stamps)
+		while True:
+			if changed:
+				start = time.perf_counter()
+				try:
+					converted = self.rebuild(changed)
+				except (KeyError, OSError, ValueError) as error:
+					if report:
+						report(error, time.perf_counter() - start)
+				else:
+					if report:
+						report(converted, time.perf_counter() - start)
+			time.sleep(interval)
+			changed = self.poll()
+			more = changed
+			while more:
+				time.sleep(debounce)
+				more = self.poll()
+				changed |= more
+
+def _convert_batch(requests):
+	"""_convert_batch converts a batch of text and template pairs in a worker process, returning whether each succeeded along with its LaTeX or error"""
+	results = []
+	for text, template in requests:
+		try:
+			latex = _CONVERTER.markdownify(text)
+		except Exception as error:
+			results.append((False, str(error.args[0]) if error.args else type(error).__name__))
+			continue
+		results.append((True, Template(template).render({'BODY': latex}) if template else latex))
+	return results
+
+class ConversionServer:
+	"""ConversionServer converts Markdown sent to it over HTTP, on a local port or a Unix socket, on a pool of warm worker processes
+
+	POST /convert takes a JSON object with the text to convert and optionally a template whose %BODY% it goes into, and
+	answers with an object holding the latex or an error. Requests that arrive while the workers are busy are converted
+	in batches of up to batch_size. GET /stats answers with the number of requests, batches and errors, the number of
+	requests queued and running and percentiles of the latency of the last requests in milliseconds. target is the
+	Target every conversion is rendered for.
+	"""
+	def __init__(self, jobs=None, batch_size=16, references=None, target=None):
+		self.jobs = jobs or os.cpu_count()
+		self.batch_size = batch_size
+		self.references = references
+		self.target = target
+		self.queue = None
+		self.pool = None
+		self.running = 0
+		self.latencies = deque(maxlen=1000)
+		self.counts = {'requests': 0, 'batches': 0, 'errors': 0}
+
+	async def convert(self, text, template=None):
+		"""convert queues a conversion and waits for whether it succeeded along with its LaTeX or error"""
+		future = asyncio.get_running_loop().create_future()
+		await self.queue.put((text, template, future))
+		return await future
+
+	async def _batches(self):
+		"""_batches waits for a worker to be free, then hands it whatever requests have queued up in the meantime"""
+		slots = asyncio.Semaphore(self.jobs)
+		while True:
+			await slots.acquire()
+			batch = [await self.queue.get()]
+			while len(batch) < self.batch_size and not self.queue.empty():
+				batch.append(self.queue.get_nowait())
+			asyncio.get_running_loop().create_task(self._run(batch, slots))
+
+	async def _run(self, batch, slots):
+		"""_run converts a batch on the pool and hands out the results"""
+		self.running += len(batch)
+		try:
+			results = await asyncio.get_running_loop().run_in_executor(self.pool, _convert_batch, [request[:2] for request in batch])
+		except Exception as error:
+			results = [(False, str(error))] * len(batch)
+		finally:
+			self.running -= len(batch)
+			slots.release()
+		self.counts['batches'] += 1
+		for (_, _, future), result in zip(batch, results):
+			if not future.cancelled():
+				future.set_result(result)
+
+	def stats(self):
+		"""stats returns the counts, queue depth and latency percentiles of the server"""
+		latencies = sorted(self.latencies)
+		percentiles = {}
+		for percentile in (50, 90, 99):
+			percentiles['p%d' % percentile] = latencies[len(latencies) * percentile // 100] * 1000 if latencies else 0.0
+		return dict(self.counts, queued=self.queue.qsize(), running=self.running, latency_ms=percentiles)
+
+	async def _respond(self, method, path, body):
+		"""_respond answers a single request with a status and a JSON object"""
+		if path == '/stats' and method == 'GET':
+			return HTTPStatus.OK, self.stats()
+		if path != '/convert':
+			return HTTPStatus.NOT_FOUND, {'error': "no such path '%s'" % path}
+		if method != 'POST':
+			return HTTPStatus.METHOD_NOT_ALLOWED, {'error': 'conversions have to be posted'}
+		start = time.perf_counter()
+		try:
+			request = json.loads(body)
+			text, template = request['text'], request.get('template')
+			if not isinstance(text, str) or not isinstance(template, (str, type(None))):
+				raise TypeError
+		except (ValueError, KeyError, TypeError, AttributeError):
+			return HTTPStatus.BAD_REQUEST, {'error': 'expected a JSON object with a text and optionally a template'}
+		self.counts['requests'] += 1
+		succeeded, result = await self.convert(text, template)
+		self.latencies.append(time.perf_counter() - start)
+		if not succeeded:
+			self.counts['errors'] += 1
+			return HTTPStatus.UNPROCESSABLE_ENTITY, {'error': result}
+		return HTTPStatus.OK, {'latex': result}
+
+	async def _handle(self, reader, writer):
+		"""_handle answers the HTTP requests made over a connection until it is closed"""
+		try:
+			while True:
+				request = await reader.readline()
+				if not request:
+					break
+				method, path, _ = request.decode('latin-1').split(' ', 2)
+				headers = {}
+				line = await reader.readline()
+				while line.strip():
+					name, _, value = line.decode('latin-1').partition(':')
+					headers[name.strip().lower()] = value.strip()
+					line = await reader.readline()
+				body = await reader.readexactly(int(headers.get('content-length', 0)))
+				status, response = await self._respond(method, path, body)
+				payload = json.dumps(response).encode('utf-8')
+				writer.write(b'HTTP/1.1 %d %s\r\nContent-Type: application/json\r\nContent-Length: %d\r\n\r\n' % (status, status.phrase.encode(), len(payload)) + payload)
+				await writer.drain()
+				if headers.get('connection', '').lower() == 'close':
+					break
+		except (ValueError, asyncio.IncompleteReadError, ConnectionError):
+			pass
+		finally:
+			writer.close()
+
+	async def start(self, address):
+		"""start sets up the pool and listens on address, either host:port or the path of a Unix socket, returning the asyncio server"""
+		self.queue = asyncio.Queue()
+		# Forked workers would hold on to the sockets of the connections open at the time, so they are spawned and warmed up before any
+		self.pool = ProcessPoolExecutor(max_workers=self.jobs, mp_context=multiprocessing.get_context('spawn'), initializer=_init_worker, initargs=(None, None, None, self.references, self.target))
+		await asyncio.gather(*(asyncio.get_running_loop().run_in_executor(self.pool, _convert_batch, []) for _ in range(self.jobs)))
+		self.batcher = asyncio.get_running_loop().create_task(self._batches())
+		if ':' in address:
+			host, port = address.rsplit(':', 1)
+			return await asyncio.start_server(self._handle, host, int(port))
+		return await asyncio.start_unix_server(self._handle, address)
+
+	def close(self):
+		"""close stops handing out batches and shuts the pool down"""
+		self.batcher.cancel()
+		self.pool.shutdown(cancel_futures=True)
+
+	async def serve(self, address):
+		"""serve answers requests on address until it is cancelled"""
+		server = await self.start(address)
+		try:
+			async with server:
+				await server.serve_forever()
+		finally:
+			self.close()
 
 if __name__ == "__main__":
 	PARSER = argparse.ArgumentParser(description='This is a script designed to convert a file with Markdown-style formatting into a comparable LaTeX file.')
-	PARSER.add_argument('-i', '--input-file', help='Markdown-style file to be converted.', required=True)
-	PARSER.add_argument('-o', '--output-file', help='File where the generated LaTeX code will be written to. If not, the script will output to stdout.', required=False, default="")
-	PARSER.add_argument('-t', '--template', help=r'Template file. If set, the script will attempt to replace the \%BODY\% with the LaTeX code generated by the script.', required=False, default='')
+	INPUT = PARSER.add_mutually_exclusive_group(required=True)
+	INPUT.add_argument('-i', '--input-file', help='Markdown-style file to be converted.')
+	INPUT.add_argument('-s', '--serve', help='Address to serve conversions on over HTTP, either host:port or the path of a Unix socket. Post a JSON object with the text and optionally the template to /convert, and get the stats from /stats.')
+	INPUT.add_argument('-p', '--project', help='Directory, manifest file listing one file per line, or glob pattern of Markdown-style files to be converted together. Each file is written to a .tex file of the same name and the reference definitions of all of them are shared.')
+	PARSER.add_argument('-o', '--output-file', help='File where the generated LaTeX code will be written to. If not, the script will output to stdout. For a project this is where the filled in template is written to.', required=False, default="")
+	PARSER.add_argument('-t', '--template', help=r'Template file. If set, the script will attempt to replace the %%BODY%% with the LaTeX code generated by the script, %%TITLE%% with the first heading and %%BIBLIOGRAPHY%% with the bibliography entries defined. For a project the code generated for all files goes into %%BODY%% in order.', required=False, default='')
+	PARSER.add_argument('-j', '--jobs', help='Number of processes used to convert a project, a single input file in chunks, or requests to a server. Defaults to the number of processors, except for an input file where it defaults to one.', required=False, type=int, default=None)
+	PARSER.add_argument('-c', '--cache', help='Database file where converted documents and blocks are cached, so that only changed ones are converted again.', required=False, default=None)
+	PARSER.add_argument('--cache-size', help='Size in megabytes past which the least recently used cache entries are evicted.', required=False, type=int, default=256)
+	PARSER.add_argument('-r', '--references', help='File of reference definitions shared by all input files, either in Markdown or saved as a reference store. The definitions of a Markdown file are indexed into a store next to it, named after it with .idx appended, which is reused until the file changes.', required=False, default=None)
+	PARSER.add_argument('--profile', help='Print the calls, time spent, bytes processed and regular expression searches and matches of every stage of the conversion of an input file to stderr. These are the stages of the single pass engine, such as _protect, _tokenize, _render_node and scan_definitions, or with --legacy those of the legacy pipeline, such as _headings, _lists, _emphasise and _references. They are printed as a table followed by the peak memory use of the process, or as JSON with the stages under stages and the peak memory use in bytes under peak_rss_bytes.', required=False, nargs='?', const='table', choices=('table', 'json'), default=None)
+	PARSER.add_argument('--legacy', help='Convert an input file with the legacy pipeline, which runs one regular expression stage after another over the whole text, rather than with the single pass engine. The command line converts with the single pass engine by default, whose output differs from that of the legacy pipeline in a few places listed in the README. The legacy pipeline only renders for book and cannot be combined with a cache or several jobs.', required=False, action='store_true')
+	PARSER.add_argument('--target', help='Kind of document to render for, which decides what headings, figures and links become. book turns # into chapters, article and beamer turn it into sections, and beamer leaves figures bare.', required=False, choices=sorted(TARGETS), default='book')
+	PARSER.add_argument('--batch-size', help='Number of requests a server hands to a worker process at once at most.', required=False, type=int, default=16)
+	PARSER.add_argument('-d', '--output-dir', help='Directory where the files generated for a project are written to. Defaults to the directory of each input file.', required=False, default=None)
+	PARSER.add_argument('-w', '--watch', help='Keep converting the input file or project whenever it, the template or the references change, converting only the files a change affects and printing how long every rebuild took to stderr. An input file needs an output file.', required=False, action='store_true')
+	PARSER.add_argument('--interval', help='Seconds between checks for changes when watching.', required=False, type=float, default=0.5)
+	PARSER.add_argument('--debounce', help='Seconds the files have to stay unchanged after a change before they are converted again when watching.', required=False, type=float, default=0.2)
 	#with open('example.md') as f:
 	#	d = f.read()
 	#print(MarkdownToLatex().markdownify(d))
 	ARGS = vars(PARSER.parse_args())
+
+	def report(converted, seconds):
+		if isinstance(converted, Exception):
+			print('Rebuild failed after %.1f ms: %s' % (seconds * 1000, converted), file=sys.stderr)
+		else:
+			print('Rebuilt%s in %.1f ms' % (' ' + ', '.join(converted) if converted else '', seconds * 1000), file=sys.stderr)
+
+	def watch(files, targets, output=None):
+		try:
+			ProjectWatcher(files, targets, ARGS['references'], ARGS['template'], output, TARGETS[ARGS['target']]).watch(ARGS['interval'], ARGS['debounce'], report)
+		except KeyboardInterrupt:
+			pass
+		exit()
+	if ARGS['template'] and not os.path.exists(ARGS['template']):
+		print("Template file '%s' not found" % ARGS['template'])
+		exit()
+	if ARGS['references'] and not os.path.exists(ARGS['references']):
+		print("References file '%s' not found" % ARGS['references'])
+		exit()
+	if ARGS['serve']:
+		try:
+			asyncio.run(ConversionServer(ARGS['jobs'], ARGS['batch_size'], ReferenceStore.open(ARGS['references']).path if ARGS['references'] else None, TARGETS[ARGS['target']]).serve(ARGS['serve']))
+		except KeyboardInterrupt:
+			pass
+		exit()
+	if ARGS['project']:
+		FILES = project_files(ARGS['project'])
+		if not FILES:
+			print("No input files found for '%s'" % ARGS['project'])
+			exit()
+		if ARGS['watch']:
+			watch(FILES, _targets(FILES, ARGS['output_dir']), ARGS['output_file'] or sys.stdout)
+		OUTPUTS = markdown_project(FILES, ARGS['jobs'], ARGS['output_dir'], ARGS['cache'], ARGS['cache_size'] * 1024 * 1024, ARGS['references'], TARGETS[ARGS['target']])
+		if ARGS['template']:
+			if ARGS['output_file']:
+				with _replacing(ARGS['output_file']) as f:
+					assemble(ARGS['template'], OUTPUTS, f)
+			else:
+				assemble(ARGS['template'], OUTPUTS, sys.stdout)
+				print()
+		exit()
 	if not os.path.exists(ARGS['input_file']):
 		print("Input file '%s' not found" % ARGS['input_file'])
 		exit()
-	if ARGS['template']:
-		if not os.path.exists(ARGS['template']):
-			print("Template file '%s' not found" % ARGS['template'])
+	if ARGS['watch']:
+		if not ARGS['output_file']:
+			print('Watching an input file needs an output file')
 			exit()
-		OUTPUT = MarkdownToLatex().markdown_template(ARGS['input_file'], ARGS['template'])
+		watch([ARGS['input_file']], [ARGS['output_file']])
+	if ARGS['legacy'] and (ARGS['cache'] or (ARGS['jobs'] or 1) > 1 or ARGS['target'] != 'book'):
+		print('The legacy pipeline cannot be combined with a cache, several jobs or a target other than book')
+		exit()
+	STATS = ConversionStats() if ARGS['profile'] else None
+	REFERENCES = ReferenceStore.open(ARGS['references']) if ARGS['references'] else None
+	if ARGS['cache']:
+		CONVERTER = MarkdownToLatex(single_pass=True, cache=ConversionCache(ARGS['cache'], ARGS['cache_size'] * 1024 * 1024), stats=STATS, references=REFERENCES, target=TARGETS[ARGS['target']])
+	else:
+		CONVERTER = MarkdownToLatex(single_pass=not ARGS['legacy'], stats=STATS, references=REFERENCES, jobs=ARGS['jobs'] or 1, target=TARGETS[ARGS['target']])
+	if ARGS['template']:
+		OUTPUT = CONVERTER.markdown_template_stream(ARGS['input_file'], ARGS['template'])
+	elif ARGS['legacy'] or ARGS['cache'] or CONVERTER.jobs > 1:
+		OUTPUT = [CONVERTER.markdown_file(ARGS['input_file'])]
 	else:
-		OUTPUT = MarkdownToLatex().markdown_file(ARGS['input_file'])
+		OUTPUT = CONVERTER.markdown_file_stream(ARGS['input_file'])
 
 	if ARGS['output_file']:
-		with open(ARGS['output_file'], 'w') as f:
-			f.write(OUTPUT)
+		with _replacing(ARGS['output_file']) as f:
+			f.writelines(OUTPUT)
 	else:
-		print(OUTPUT)
-		
\ No newline at end of file
+		sys.stdout.writelines(OUTPUT)
+		print()
+	# ru_maxrss is in kilobytes on Linux and in bytes on macOS
+	PEAK = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * (1 if sys.platform == 'darwin' else 1024) if resource else None
+	if ARGS['profile'] == 'json':
+		json.dump({'stages': STATS.stages, 'peak_rss_bytes': PEAK}, sys.stderr, indent='\t')
+		print(file=sys.stderr)
+	elif ARGS['profile']:
+		print(STATS.report(), file=sys.stderr)
+		if PEAK is not None:
+			print('peak RSS %.1f MB' % (PEAK / 1024 / 1024), file=sys.stderr)
\ No newline at end of file
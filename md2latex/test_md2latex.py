@@ -1,5 +1,12 @@
 #!/usr/bin/env python3
-from md2latex import MarkdownToLatex
+from md2latex import MarkdownToLatex, ConversionCache, ConversionStats, ReferenceStore, ConversionServer, Template, Target, TARGETS, ParsedDocument, project_files, markdown_project, assemble, convert_concurrently, ProjectWatcher, MappedLines, _replacing
+import bench_md2latex
+import asyncio
+import json
+import io
+import os
+import tempfile
+import time
 import unittest
 
 class Emphasis(unittest.TestCase):
@@ -53,7 +60,18 @@ class Emphasis(unittest.TestCase):
 		tests = [r"\*not emphasised\*", r"\*\*not bolded\*\*"]
 		for test in tests:
 			self.assertEqual(MarkdownToLatex()._emphasise(test), test)
-		
+
+	def testLiteralMonospace(self):
+		"""_emphasise should not emphasise anything within monospace"""
+		result = MarkdownToLatex()._emphasise("`snake_case_name` and *emphasis*")
+		self.assertEqual(result, "\\texttt{snake_case_name} and \\emph{emphasis}")
+
+	def testBalancedBraces(self):
+		"""_emphasise should leave delimiters that cross others or lines alone"""
+		tests = [("*a **b* c**", "\\emph{a **b} c**"), ("***a***", "\\textbf{\\emph{a}}"), ("*a\nb*", "*a\nb*")]
+		for test, result in tests:
+			self.assertEqual(MarkdownToLatex()._emphasise(test), result)
+
 class Headings(unittest.TestCase):
 	def testChapterHeading(self):
 		tests = [("Chapter\n====", "\chapter{Chapter}"), ("Example\n=", "\chapter{Example}")]
@@ -142,6 +160,16 @@ class Lists(unittest.TestCase):
 		test = ("* List item\n\n\tof two paragraphs\n* Another\n\n    one", "\\begin{itemize}\n\item List item\\\\ of two paragraphs\n\item Another\\\\ one\n\end{itemize}")
 		self.assertEqual(MarkdownToLatex()._lists(test[0]), test[1])
 
+	def testNestedLists(self):
+		"""_lists should nest lists by the indentation of their items"""
+		test = ("* a\n    * b\n\t\t1. c\n    * d\n* e\nText", "\\begin{itemize}\n\\item a\n\\begin{itemize}\n\\item b\n\\begin{enumerate}\n\\item c\n\\end{enumerate}\n\\item d\n\\end{itemize}\n\\item e\n\\end{itemize}\nText")
+		self.assertEqual(MarkdownToLatex()._lists(test[0]), test[1])
+		self.assertEqual(MarkdownToLatex(single_pass=True).markdownify(test[0]), test[1])
+
+	def testLeadingBlankLine(self):
+		"""_lists should not trip over a blank line at the start"""
+		self.assertEqual(MarkdownToLatex()._lists("\n* a"), "\\\\\n\\begin{itemize}\n\\item a\n\\end{itemize}")
+
 class Footnotes(unittest.TestCase):
 	def testFootnote(self):
 		"""_footnote should convert the text between ^( ... ) into footnotes"""
@@ -219,6 +247,11 @@ class References(unittest.TestCase):
 		test = ('Read ^[smith][short].\nThen read ^[smith][long] again.\nThen check ^[smith][bib]\n[smith]: "Smith, Jane. *Long titles*, Somewhere: i Press, 2016." "Jane Smith, *Long titles* (Somewhere: i Press, 2016)" "Smith, *Long titles*"', 'Read Smith, *Long titles*.\nThen read Jane Smith, *Long titles* (Somewhere: i Press, 2016) again.\nThen check Smith, Jane. *Long titles*, Somewhere: i Press, 2016.\n')
 		self.assertEqual(MarkdownToLatex()._references(test[0]), test[1])
 		
+	def testSeveralReferencesOnOneLine(self):
+		"""_references should resolve every reference on a line on its own"""
+		test = 'See ^[smith][], ^[smith][] and ^[smith][bib] or [a][].\n[smith]: "Bib" "Long" "Short"\n[a]: a.org "A"'
+		self.assertEqual(MarkdownToLatex()._references(test), 'See Long, Short and Bib or \href{a.org}{A}.\n\n')
+
 	def testErroneousKeyedBibReferences(self):
 		"""_references should raise an error if the key for a bibliographical reference from is not either long, short, or bib"""
 		test = 'Read ^[smith][wrong].\n[smith]: "Smith, Jane. *Long titles*, Somewhere: i Press, 2016." "Jane Smith, *Long titles* (Somewhere: i Press, 2016)" "Smith, *Long titles*"'
@@ -237,5 +270,616 @@ class Quotes(unittest.TestCase):
 		result = MarkdownToLatex()._quotes(test)
 		self.assertEqual(result, test)
 
+	def testQuoteInText(self):
+		"""_quotes should only take lines starting with > for quotations"""
+		test = "a > b"
+		self.assertEqual(MarkdownToLatex()._quotes(test), test)
+
+class Code(unittest.TestCase):
+	def testFencedCode(self):
+		"""markdownify should leave fenced code alone and put it in a lstlisting environment if it names its language"""
+		test = "# include\n```c\n#include <stdio.h>\nint *snake_case*;\n\n```\n~~~\n[x]: y \"z\"\n~~~\nText _x_"
+		result = "\\chapter{include}\n\\begin{lstlisting}[language=c]\n#include <stdio.h>\nint *snake_case*;\n\n\\end{lstlisting}\n\\begin{verbatim}\n[x]: y \"z\"\n\\end{verbatim}\nText \\emph{x}"
+		self.assertEqual(MarkdownToLatex().markdownify(test), result)
+		self.assertEqual(MarkdownToLatex(single_pass=True).markdownify(test), result)
+
+	def testIndentedCode(self):
+		"""markdownify should take lines indented after a blank line for code, unless they continue a list item"""
+		test = "Text\n\n    a_b_c\n\n\t> d\n* Item\n\n    continued"
+		result = "Text\\\\\n\\begin{verbatim}\na_b_c\n\n> d\n\\end{verbatim}\n\\begin{itemize}\n\\item Item\\\\ continued\n\\end{itemize}"
+		self.assertEqual(MarkdownToLatex().markdownify(test), result)
+		self.assertEqual(MarkdownToLatex(single_pass=True).markdownify(test), result)
+
+	def testDefinitionsInCode(self):
+		"""scan_definitions should skip definitions inside code"""
+		test = ['```', '[a]: "B" "L" "S"', '```', '[a]: "b" "l" "s"']
+		self.assertEqual(MarkdownToLatex().scan_definitions(test)[0], {'a': {'bib': 'b', 'long': 'l', 'short': 's'}})
+
+class SinglePass(unittest.TestCase):
+	def testMatchesLegacyPipeline(self):
+		"""markdownify should produce the same output with the single pass engine as with the legacy pipeline"""
+		tests = ["# Chapter\n## Section\nChapter\n====\n\nSection\n-----\n* Test\n- Example",
+		"* List item\n\tconsisting\n    of multiple hardwrapped lines\n\n1. Beer\n* Cars\n3. Boats\nText",
+		"* List item\n\n\tof two paragraphs\n* Another\n\n    one",
+		"^(A test footnote) and **b** `c` *d* __e__ _f_ \*g\*",
+		'Visit [google][] to search more.\n[google]: <www.google.com> "Google"\n![test][]\n[test]: /test/image "Test"',
+		'Read ^[smith][].\nThen read ^[smith][] again.\n[smith]: "Smith, Jane." "Jane Smith, Long titles" "Smith, Long"',
+		'![test_b](/path/to/other/test.jpg "Title") and ![test](/path/test.jpg)\n[This link](http://example.net/)',
+		"* a\n> b\n\n> *c*\n    d\n# e\n> f\n1. g\n> h\n```\ni\n```\n> j",
+		"a\n\n", "* x\n\n", "```\ni\n```\n* x\n\n"]
+		for test in tests:
+			self.assertEqual(MarkdownToLatex(single_pass=True).markdownify(test), MarkdownToLatex().markdownify(test))
+
+	def testHashesInLines(self):
+		"""markdownify should only take a # at the start of a line for a heading with the single pass engine, unlike the legacy pipeline"""
+		tests = [('Issue #12 is fixed', 'Issue \\chapter{12 is fixed}'), ('C# and F#', 'C\\chapter{and F}'),
+			('* item #3', '\\begin{itemize}\n\\item item \\chapter{3}\n\\end{itemize}'),
+			('See [a](http://x.org/#frag).', 'See \\href{http://x.org/\\chapter{frag}{a}.}')]
+		for test, legacy in tests:
+			self.assertEqual(MarkdownToLatex().markdownify(test), legacy)
+		results = [MarkdownToLatex(single_pass=True).markdownify(test) for test, legacy in tests]
+		self.assertEqual(results, ['Issue #12 is fixed', 'C# and F#', '\\begin{itemize}\n\\item item #3\n\\end{itemize}', 'See \\href{http://x.org/#frag}{a}.'])
+
+	def testPlaceholderCharacters(self):
+		"""markdownify should drop the characters placeholders are made of rather than take the input for a placeholder"""
+		tests = [('\x01x', 'x'), ('\x010\x01', '0'), ('a \x000\x00 b', 'a 0 b'), ('\x01-\x01\n* x', '-\n\\begin{itemize}\n\\item x\n\\end{itemize}')]
+		for test, result in tests:
+			self.assertEqual(MarkdownToLatex(single_pass=True).markdownify(test), result)
+			self.assertEqual(''.join(MarkdownToLatex().markdownify_stream(test.splitlines())), result)
+			self.assertEqual(MarkdownToLatex().markdownify(test), result)
+			self.assertEqual(MarkdownToLatex().markdownify_many([test, test]), [result, result])
+
+	def testSeveralReferencesOnOneLine(self):
+		"""markdownify should resolve every reference on a line on its own"""
+		test = 'See ^[smith][], ^[smith][] and ^[smith][bib] or [a][] and [b](b.org).\n[smith]: "Bib" "Long" "Short"\n[a]: a.org "A"'
+		result = MarkdownToLatex(single_pass=True).markdownify(test)
+		self.assertEqual(result, 'See Long, Short and Bib or \href{a.org}{A} and \href{b.org}{b}.\n\n')
+
+	def testAddressesAreNotEmphasised(self):
+		"""markdownify should leave underscores in link addresses alone"""
+		result = MarkdownToLatex(single_pass=True).markdownify('[a _b_](http://example.com/a_b_c)')
+		self.assertEqual(result, '\href{http://example.com/a_b_c}{a \emph{b}}')
+
+	def testDefinitionsAreEmphasised(self):
+		"""markdownify should render the markup inside bibliography entries"""
+		test = 'Read ^[smith][].\n[smith]: "Smith, *T*." "Jane Smith, *T*" "Smith, *T*"'
+		result = MarkdownToLatex(single_pass=True).markdownify(test)
+		self.assertEqual(result, 'Read Jane Smith, \emph{T}.\n')
+
+class Batch(unittest.TestCase):
+	def testMatchesMarkdownify(self):
+		"""markdownify_many should return what markdownify returns for every text, in order"""
+		tests = ['', 'Title', '---', '\n\nText', '\tindented', '* a\n  * b', '> quote', '```\nunclosed *code*', 'Section\n-------\n*a* **b** `c_d`',
+			'See ^[a][] and ^[a][].\n[a]: "B" "L" "S"', 'Again ^[a][].\n[a]: "b" "l" "s"', '\n', 'Text\n\n    code\n\n', '# Chapter\n1. one\n\n    two']
+		converter = MarkdownToLatex()
+		expected = [converter.markdownify(test) for test in tests]
+		self.assertEqual(converter.markdownify_many(tests), expected)
+		self.assertEqual(converter.markdownify_many(iter(tests), batch_size=3), expected)
+		converter = MarkdownToLatex(single_pass=True)
+		self.assertEqual(converter.markdownify_many(tests), [converter.markdownify(test) for test in tests])
+
+	def testDefinitionsStayInTheirText(self):
+		"""markdownify_many should not resolve a reference against the definitions of another text"""
+		self.assertRaises(KeyError, MarkdownToLatex().markdownify_many, ['[a]: www.a.org "A"', 'See [a][].'])
+
+class Threads(unittest.TestCase):
+	def testSharedConverter(self):
+		"""convert_concurrently should convert every text as markdownify does, with one converter, cache and stats shared by all threads"""
+		tests = [bench_md2latex.generate_corpus(4096, seed=seed) for seed in range(16)]
+		expected = [MarkdownToLatex().markdownify(test) for test in tests]
+		with tempfile.TemporaryDirectory() as directory:
+			stats = ConversionStats()
+			converter = MarkdownToLatex(cache=ConversionCache(os.path.join(directory, 'cache.db')), stats=stats)
+			self.assertEqual(convert_concurrently(tests, 4, converter), expected)
+			self.assertEqual(convert_concurrently(tests, 4, converter), expected)
+		self.assertEqual(stats.stages['_headings']['calls'], len(tests))
+		self.assertEqual(convert_concurrently(tests, 4, MarkdownToLatex(single_pass=True)), [MarkdownToLatex(single_pass=True).markdownify(test) for test in tests])
+
+class Watch(unittest.TestCase):
+	def testRebuildsAffectedFiles(self):
+		"""ProjectWatcher should convert a changed file again along with the files using a definition it changed, and nothing else"""
+		with tempfile.TemporaryDirectory() as directory:
+			files = [os.path.join(directory, name) for name in ('a.md', 'b.md', 'c.md')]
+			texts = ['# A\n[x]: www.x.org "X"\n', 'See [x][].\n', 'Just *text*.\n']
+			for file, text in zip(files, texts):
+				with open(file, 'w') as md_file:
+					md_file.write(text)
+			targets = markdown_project(files, 1)
+			watcher = ProjectWatcher(files, targets)
+			self.assertEqual(watcher.rebuild(set(files)), files)
+			def edit(file, text):
+				with open(file, 'w') as md_file:
+					md_file.write(text)
+				os.utime(file, ns=(time.time_ns() + 10 ** 9, time.time_ns() + 10 ** 9))
+				return watcher.poll()
+			self.assertEqual(watcher.rebuild(edit(files[0], '# A\n[x]: www.y.org "Y"\n')), files[:2])
+			with open(targets[1]) as tex_file:
+				self.assertIn('www.y.org', tex_file.read())
+			self.assertEqual(watcher.rebuild(edit(files[2], 'Just _text_.\n')), files[2:])
+			self.assertEqual(watcher.rebuild(edit(files[0], '# B\n[x]: www.y.org "Y"\n')), files[:1])
+			self.assertEqual(watcher.rebuild(watcher.poll()), [])
+
+	def testTemplate(self):
+		"""ProjectWatcher should resolve references against every file when filling in a template, and keep a target whose rebuild failed"""
+		with tempfile.TemporaryDirectory() as directory:
+			files = [os.path.join(directory, name) for name in ('a.md', 'b.md')]
+			template = os.path.join(directory, 'template.tex')
+			for path, text in zip(files + [template], ['# A\nSee [g][].\n', '[g]: www.g.org "G"\n', 'head\n%BODY%\n']):
+				with open(path, 'w') as text_file:
+					text_file.write(text)
+			targets = [os.path.join(directory, name) for name in ('a.tex', 'b.tex')]
+			output = io.StringIO()
+			ProjectWatcher(files, targets, template=template, output=output).rebuild(set(files))
+			self.assertIn('\\href{www.g.org}{G}', output.getvalue())
+			watcher = ProjectWatcher(files, targets, template=template)
+			watcher.rebuild(set(files))
+			with open(targets[0]) as tex_file:
+				result = tex_file.read()
+			self.assertIn('\\href{www.g.org}{G}', result)
+			with open(files[0], 'w') as md_file:
+				md_file.write('# A\nSee [h][].\n')
+			os.utime(files[0], ns=(time.time_ns() + 10 ** 9, time.time_ns() + 10 ** 9))
+			self.assertRaises(KeyError, watcher.rebuild, watcher.poll())
+			with open(targets[0]) as tex_file:
+				self.assertEqual(tex_file.read(), result)
+			self.assertEqual(sorted(os.listdir(directory)), ['a.md', 'a.tex', 'b.md', 'b.tex', 'template.tex'])
+
+class Replacing(unittest.TestCase):
+	def testReplace(self):
+		"""_replacing should replace a regular file only once it is written, keeping its mode"""
+		with tempfile.TemporaryDirectory() as directory:
+			path = os.path.join(directory, 'out.tex')
+			with open(path, 'w') as tex_file:
+				tex_file.write('old')
+			os.chmod(path, 0o640)
+			with self.assertRaises(KeyError):
+				with _replacing(path) as tex_file:
+					tex_file.write('new')
+					raise KeyError('a')
+			with open(path) as tex_file:
+				self.assertEqual(tex_file.read(), 'old')
+			with _replacing(path) as tex_file:
+				tex_file.write('new')
+			with open(path) as tex_file:
+				self.assertEqual(tex_file.read(), 'new')
+			self.assertEqual(os.stat(path).st_mode & 0o777, 0o640)
+			self.assertEqual(os.listdir(directory), ['out.tex'])
+
+	def testSymlink(self):
+		"""_replacing should write through a symbolic link rather than replace the link"""
+		with tempfile.TemporaryDirectory() as directory:
+			real = os.path.join(directory, 'real.tex')
+			link = os.path.join(directory, 'link.tex')
+			with open(real, 'w') as tex_file:
+				tex_file.write('old')
+			os.chmod(real, 0o640)
+			os.symlink(real, link)
+			with _replacing(link) as tex_file:
+				tex_file.write('new')
+			self.assertTrue(os.path.islink(link))
+			with open(real) as tex_file:
+				self.assertEqual(tex_file.read(), 'new')
+			self.assertEqual(os.stat(real).st_mode & 0o777, 0o640)
+
+class Targets(unittest.TestCase):
+	def testTargets(self):
+		"""markdownify should render headings, figures and links as the target says"""
+		test = '# Title\n##### Deep\nSee ![a](a.png "A") and [b](b.org).'
+		tests = [(Target(), '\\chapter{Title}\n\\subsubsection{Deep}\nSee \\begin{figure}\n\\includegraphics{a.png}\n\\caption{A}\n\\end{figure} and \\href{b.org}{b}.'),
+			(Target(1, None, 'footnote'), '\\section{Title}\n\\paragraph{Deep}\nSee \\includegraphics{a.png} and b\\footnote{\\url{b.org}}.')]
+		for target, result in tests:
+			self.assertEqual(MarkdownToLatex(single_pass=True, target=target).markdownify(test), result)
+		target, result = tests[1]
+		self.assertEqual(MarkdownToLatex(target=target).markdownify(test), result)
+		self.assertEqual(MarkdownToLatex(target=target).markdownify_many([test, test]), [result, result])
+
+	def testParsedDocument(self):
+		"""ParsedDocument should render every target as markdownify does, also once it has been saved and loaded again"""
+		with open('example.md') as example:
+			test = example.read()
+		document = ParsedDocument.loads(MarkdownToLatex().parse(test).dumps())
+		for target in TARGETS.values():
+			self.assertEqual(document.render(target), MarkdownToLatex(single_pass=True, target=target).markdownify(test))
+
+class Mapped(unittest.TestCase):
+	def testLines(self):
+		"""MappedLines should read a file line by line as iterating over it does, without the line endings"""
+		tests = ['', 'one', 'one\n', 'one\r\ntwo\n\n', '\nünï\ncödé', 'a\rb\r* c\r', '# a\x0cb\u2028c\x85d\r\r\ne\x1c']
+		with tempfile.TemporaryDirectory() as directory:
+			path = os.path.join(directory, 'test.md')
+			for test in tests:
+				with open(path, 'w', newline='', encoding='utf-8') as md_file:
+					md_file.write(test)
+				result = test.splitlines()
+				with MappedLines(path) as lines:
+					self.assertEqual(list(lines), result)
+					self.assertEqual([lines[index] for index in range(-len(lines), len(lines))], result * 2)
+
+	def testMarkdownFile(self):
+		"""markdown_file should convert a mapped file as markdownify converts its text"""
+		with open('example.md') as example:
+			test = example.read()
+		self.assertEqual(MarkdownToLatex(single_pass=True).markdown_file('example.md'), MarkdownToLatex(single_pass=True).markdownify(test))
+		self.assertEqual(''.join(MarkdownToLatex().markdown_file_stream('example.md')), MarkdownToLatex(single_pass=True).markdownify(test))
+		with tempfile.TemporaryDirectory() as directory:
+			path = os.path.join(directory, 'test.md')
+			with open(path, 'w', newline='') as md_file:
+				md_file.write('a\rb\r* c\r# d\x0ce')
+			result = MarkdownToLatex(single_pass=True).markdownify('a\nb\n* c\n# d\ne')
+			self.assertEqual(MarkdownToLatex(single_pass=True).markdown_file(path), result)
+			self.assertEqual(''.join(MarkdownToLatex().markdown_file_stream(path)), result)
+
+class Parallel(unittest.TestCase):
+	def testMatchesSinglePass(self):
+		"""markdownify should convert chunks in parallel to the same output as the single pass engine"""
+		test = ('^[a][] ' + 'x' * 1000 + '\n') * 100 + ('* item ' + 'y' * 1000 + '\n') * 100 + '1. z\n' * 3 + '\n[a]: "B" "L" "S"'
+		result = MarkdownToLatex(jobs=2).markdownify(test)
+		self.assertEqual(result, MarkdownToLatex(single_pass=True).markdownify(test))
+		self.assertEqual(result.count('\\begin{itemize}'), 1)
+		self.assertEqual(result.count('L x'), 1)
+
+	def testFencedCodeAcrossChunks(self):
+		"""markdownify should not split a document inside a fenced code block"""
+		test = 'Text\n```\n' + '# a_b\n' * 30000 + '```\n> after'
+		self.assertEqual(MarkdownToLatex(jobs=2).markdownify(test), MarkdownToLatex(single_pass=True).markdownify(test))
+
+	def testDuplicateKeyAcrossChunks(self):
+		"""markdownify should not allow a key to be defined in two chunks"""
+		test = '[a]: "B" "L" "S"\n' + ('x' * 1000 + '\n') * 200 + '[a]: "B" "L" "S"'
+		self.assertRaises(KeyError, MarkdownToLatex(jobs=2).markdownify, test)
+
+class Streaming(unittest.TestCase):
+	def testMatchesMarkdownify(self):
+		"""markdownify_stream should yield chunks that join up to the output of markdownify"""
+		with open('example.md') as example:
+			test = example.read()
+		result = ''.join(MarkdownToLatex().markdownify_stream(test.splitlines(True)))
+		self.assertEqual(result, MarkdownToLatex(single_pass=True).markdownify(test))
+
+	def testYieldsBeforeTheEnd(self):
+		"""markdownify_stream should yield converted lines before it has read all of its input"""
+		lines = iter(['*a*', 'b', 'c', 'd'])
+		stream = MarkdownToLatex().markdownify_stream(lines)
+		self.assertEqual(next(stream), '\emph{a}')
+		self.assertEqual(list(lines), ['d'])
+
+	def testForwardReference(self):
+		"""markdownify_stream should hold back references used before their definition until it turns up"""
+		test = ['Visit [google][] to search more.', 'More text.', '[google]: <www.google.com> "Google"']
+		result = list(MarkdownToLatex().markdownify_stream(test))
+		self.assertEqual(result, ['Visit \href{www.google.com}{Google} to search more.', '\nMore text.', '\n'])
+
+	def testScannedDefinitions(self):
+		"""markdownify_stream should not hold anything back if the definitions have been scanned beforehand"""
+		test = ['Visit [google][] to search more.', 'More text.', '[google]: <www.google.com> "Google"']
+		converter = MarkdownToLatex()
+		stream = converter.markdownify_stream(iter(test), converter.scan_definitions(test))
+		self.assertEqual(next(stream), 'Visit \href{www.google.com}{Google} to search more.')
+
+	def testUnknownKey(self):
+		"""markdownify_stream should raise a KeyError if a reference is never defined"""
+		stream = MarkdownToLatex().markdownify_stream(['Visit [google][] for more.', 'Text'])
+		self.assertRaises(KeyError, list, stream)
+
+class Project(unittest.TestCase):
+	def setUp(self):
+		self.directory = tempfile.TemporaryDirectory()
+		self.files = []
+		for name, text in (('a.md', '# One\nSee [g][] and ^[s][].\n[s]: "B" "L" "S"'), ('b.md', '# Two\nAgain ^[s][] and [g][].\n[g]: g.com "G"')):
+			self.files.append(os.path.join(self.directory.name, name))
+			with open(self.files[-1], 'w') as md_file:
+				md_file.write(text)
+
+	def tearDown(self):
+		self.directory.cleanup()
+
+	def testProjectFiles(self):
+		"""project_files should find the files of a project by directory, manifest or glob pattern"""
+		manifest = os.path.join(self.directory.name, 'book.txt')
+		with open(manifest, 'w') as manifest_file:
+			manifest_file.write('# chapters\nb.md\n\na.md\n')
+		self.assertEqual(project_files(self.directory.name), self.files)
+		self.assertEqual(project_files(os.path.join(self.directory.name, '*.md')), self.files)
+		self.assertEqual(project_files(manifest), self.files[::-1])
+
+	def testSharedDefinitions(self):
+		"""markdown_project should convert every file with the reference definitions of all of them"""
+		for jobs in (1, 2):
+			outputs = markdown_project(self.files, jobs)
+			self.assertEqual(outputs, [os.path.splitext(file)[0] + '.tex' for file in self.files])
+			with open(outputs[1]) as tex_file:
+				self.assertEqual(tex_file.read(), '\chapter{Two}\nAgain L and \href{g.com}{G}.\n')
+
+	def testAssemble(self):
+		"""assemble should put the generated files into the template in order"""
+		template = os.path.join(self.directory.name, 'template.tex')
+		with open(template, 'w') as temp_file:
+			temp_file.write('head\n%BODY%\ntail')
+		output = io.StringIO()
+		assemble(template, markdown_project(self.files, 1), output)
+		self.assertEqual(output.getvalue(), 'head\n\chapter{One}\nSee \href{g.com}{G} and L.\n\n\chapter{Two}\nAgain L and \href{g.com}{G}.\n\ntail')
+
+class Templates(unittest.TestCase):
+	def setUp(self):
+		self.directory = tempfile.TemporaryDirectory()
+		self.template = os.path.join(self.directory.name, 'template.tex')
+		with open(self.template, 'w') as temp_file:
+			temp_file.write('\\title{%TITLE%}\n%BODY%\n%BIBLIOGRAPHY%\n%OTHER% 100%')
+
+	def tearDown(self):
+		self.directory.cleanup()
+
+	def testChunks(self):
+		"""Template should fill in its slots, passing iterables on chunk by chunk and leaving slots without a value alone"""
+		template = Template.load(self.template)
+		self.assertEqual(template.slots, ['TITLE', 'BODY', 'BIBLIOGRAPHY', 'OTHER'])
+		chunks = list(template.chunks({'TITLE': 'T', 'BODY': iter(['a', 'b']), 'BIBLIOGRAPHY': ''}))
+		self.assertEqual(chunks, ['\\title{', 'T', '}\n', 'a', 'b', '\n', '', '\n', '%OTHER%', ' 100%'])
+
+	def testLoad(self):
+		"""Template.load should compile a template file again only once it has changed"""
+		template = Template.load(self.template)
+		self.assertIs(Template.load(self.template), template)
+		with open(self.template, 'w') as temp_file:
+			temp_file.write('%BODY%')
+		os.utime(self.template, ns=(0, 0))
+		self.assertEqual(Template.load(self.template).slots, ['BODY'])
+
+	def testMarkdownTemplate(self):
+		"""markdown_template should fill in the body, the title and the bibliography of the document"""
+		document = os.path.join(self.directory.name, 'document.md')
+		with open(document, 'w') as md_file:
+			md_file.write('# *The* title\nSee ^[a][].\n[a]: "Bib" "Long" "Short"\n')
+		result = MarkdownToLatex().markdown_template(document, self.template)
+		self.assertEqual(result, '\\title{\\emph{The} title}\n\\chapter{\\emph{The} title}\nSee Long.\n\n\\begin{thebibliography}{1}\n\\bibitem{a} Bib\n\\end{thebibliography}\n%OTHER% 100%')
+
+	def testLegacyBody(self):
+		"""markdown_template should fill in the body as markdown_file converts it, with either engine"""
+		document = os.path.join(self.directory.name, 'document.md')
+		template = os.path.join(self.directory.name, 'body.tex')
+		with open(document, 'w') as md_file:
+			md_file.write('Issue #12 is fixed\n')
+		with open(template, 'w') as temp_file:
+			temp_file.write('%BODY%')
+		for converter in (MarkdownToLatex(), MarkdownToLatex(single_pass=True)):
+			self.assertEqual(converter.markdown_template(document, template), converter.markdown_file(document))
+
+class CountingMarkdownToLatex(MarkdownToLatex):
+	rendered = 0
+
+	def _parse(self, nodes, bibliography, urls, bib_tags):
+		self.rendered += len(nodes)
+		return MarkdownToLatex._parse(self, nodes, bibliography, urls, bib_tags)
+
+class Cache(unittest.TestCase):
+	def setUp(self):
+		self.directory = tempfile.TemporaryDirectory()
+		self.cache = ConversionCache(os.path.join(self.directory.name, 'cache.db'))
+		self.file = os.path.join(self.directory.name, 'test.md')
+
+	def tearDown(self):
+		self.cache.connection.close()
+		self.directory.cleanup()
+
+	def convert(self, text, target=None):
+		with open(self.file, 'w') as md_file:
+			md_file.write(text)
+		converter = CountingMarkdownToLatex(single_pass=True, cache=self.cache, target=target)
+		result = converter.markdown_file(self.file)
+		self.assertEqual(result, MarkdownToLatex(single_pass=True, target=target).markdownify(text))
+		return result, converter.rendered
+
+	def testReusesDocument(self):
+		"""markdown_file should not convert an unchanged document again"""
+		self.convert('# Title\n\nSome *text*.')
+		self.assertEqual(self.convert('# Title\n\nSome *text*.'), ('\chapter{Title}\\\\\nSome \emph{text}.', 0))
+
+	def testReusesBlocks(self):
+		"""markdown_file should only convert the blocks of a document that changed"""
+		self.convert('First paragraph.\n\nSecond paragraph.\n\nThird paragraph.')
+		self.assertEqual(self.convert('First paragraph.\n\nSecond *paragraph*.\n\nThird paragraph.')[1], 1)
+
+	def testOtherProfile(self):
+		"""markdown_file should render the cached blocks of a document for another target without parsing them again"""
+		self.convert('# Title\n\nSee ![a](a.png "A").')
+		self.assertEqual(self.convert('# Title\n\nSee ![a](a.png "A").', TARGETS['beamer']), ('\\section{Title}\\\\\nSee \\includegraphics{a.png}.', 0))
+
+	def testDefinitionChange(self):
+		"""markdown_file should convert a block again if a definition it uses changes"""
+		self.convert('Visit [google][].\n\nOther text.\n[google]: <www.google.com> "Google"')
+		result, rendered = self.convert('Visit [google][].\n\nOther text.\n[google]: <www.google.de> "Google"')
+		self.assertEqual(result, 'Visit \href{www.google.de}{Google}.\\\\\nOther text.\n')
+		self.assertEqual(rendered, 1)
+
+	def testFirstCitation(self):
+		"""markdown_file should convert a block again if a citation in it no longer comes first"""
+		self.convert('Text.\n\nRead ^[smith][].\n[smith]: "Bib" "Long" "Short"')
+		result, rendered = self.convert('Text ^[smith][].\n\nRead ^[smith][].\n[smith]: "Bib" "Long" "Short"')
+		self.assertEqual(result, 'Text Long.\\\\\nRead Short.\n')
+
+	def testEviction(self):
+		"""ConversionCache should evict the least recently used entries once it grows too large"""
+		self.cache.max_size = 10
+		self.cache.put('a', '12345')
+		self.cache.put('b', '12345')
+		self.cache.commit()
+		time.sleep(0.01)
+		self.cache.get('a')
+		self.cache.put('c', '12345')
+		self.cache.commit()
+		self.assertEqual(self.cache.get('a'), '12345')
+		self.assertEqual(self.cache.get('b'), None)
+		self.assertEqual(self.cache.get('c'), '12345')
+
+class Benchmark(unittest.TestCase):
+	def testGenerateCorpus(self):
+		"""generate_corpus should make up the same convertible document of about the requested size for the same seed"""
+		for mix in bench_md2latex.MIXES:
+			corpus = bench_md2latex.generate_corpus(16 * 1024, mix)
+			self.assertEqual(corpus, bench_md2latex.generate_corpus(16 * 1024, mix))
+			self.assertTrue(16 * 1024 <= len(corpus) < 24 * 1024)
+			MarkdownToLatex().markdownify(corpus)
+			MarkdownToLatex(single_pass=True).markdownify(corpus)
+
+	def testAdversarial(self):
+		"""adversarial should time every shape at every size"""
+		results = bench_md2latex.adversarial((256, 512), 1)
+		self.assertEqual(list(results), list(bench_md2latex.ADVERSARIAL))
+		self.assertTrue(all(len(measured['seconds']) == 2 for measured in results.values()))
+
+	def testThreads(self):
+		"""threads should time every number of threads"""
+		results = bench_md2latex.threads((1, 2), 4, 1024, 1)
+		self.assertEqual(list(results), [1, 2])
+		self.assertEqual(results[1]['speedup'], 1.0)
+
+	def testCompare(self):
+		"""compare should report throughput and memory regressions beyond the tolerance"""
+		baseline = {'markdownify': {'seconds': 1, 'mb_per_s': 10, 'peak_bytes': 1000}, '_lists': {'seconds': 1, 'mb_per_s': 10, 'peak_bytes': 1000}}
+		results = {'markdownify': {'seconds': 1, 'mb_per_s': 8, 'peak_bytes': 1200}, '_lists': {'seconds': 1, 'mb_per_s': 7, 'peak_bytes': 1300}}
+		self.assertEqual(len(bench_md2latex.compare(results, baseline, 0.25)), 2)
+		self.assertEqual(bench_md2latex.compare(results, baseline, 0.5), [])
+
+class Profile(unittest.TestCase):
+	def testStages(self):
+		"""ConversionStats should record every stage of markdownify with its bytes, lines and searches"""
+		stats = ConversionStats()
+		result = MarkdownToLatex(stats=stats).markdownify("Some text\nMore *text*")
+		self.assertEqual(result, "Some text\nMore \emph{text}")
+		self.assertEqual(list(stats.stages), ['_protect', '_headings', '_lists', '_quotes', '_footnotes', '_emphasise', '_references'])
+		self.assertEqual(stats.stages['_lists']['calls'], 1)
+		self.assertEqual(stats.stages['_lists']['lines'], 2)
+		self.assertEqual(stats.stages['_lists']['searches'], 0)
+		self.assertEqual(stats.stages['_emphasise']['bytes_in'], 21)
+		self.assertEqual(stats.stages['_emphasise']['bytes_out'], 26)
+		self.assertEqual(stats.stages['_emphasise']['searches'], 1)
+		self.assertEqual(stats.stages['_emphasise']['matches'], 2)
+
+	def testSinglePassStages(self):
+		"""ConversionStats should record the stages of the single pass engine"""
+		stats = ConversionStats()
+		MarkdownToLatex(single_pass=True, stats=stats).markdownify("# Title\nSome text")
+		self.assertEqual(stats.stages['_tokenize']['lines'], 2)
+		self.assertEqual(stats.stages['_render_node']['calls'], 2)
+
+	def testLinesIn(self):
+		"""ConversionStats should count the bytes and lines of a stage that takes lines rather than a text"""
+		stats = ConversionStats()
+		MarkdownToLatex(stats=stats).scan_definitions(iter(['[a]: www.a.org "Ä"', 'Text']))
+		self.assertEqual(stats.stages['scan_definitions']['lines'], 2)
+		self.assertEqual(stats.stages['scan_definitions']['bytes_in'], 23)
+
+	def testNoOverhead(self):
+		"""MarkdownToLatex should not wrap anything unless it is given stats"""
+		converter = MarkdownToLatex()
+		self.assertEqual(converter._lists.__func__, MarkdownToLatex._lists)
+		self.assertTrue(all(not hasattr(value, 'stats') for value in vars(converter).values()))
+
+class SharedReferences(unittest.TestCase):
+	def setUp(self):
+		self.directory = tempfile.TemporaryDirectory()
+		self.definitions = os.path.join(self.directory.name, 'references.md')
+		with open(self.definitions, 'w') as definitions_file:
+			definitions_file.write('[smith]: "Bib" "Long" "Short"\n[google]: <www.google.com> "Google"\n[smith]: smith.org "Smith"\n')
+
+	def tearDown(self):
+		self.directory.cleanup()
+
+	def testLookup(self):
+		"""ReferenceStore should find every definition by kind, and nothing else"""
+		store = ReferenceStore.parse(self.definitions)
+		self.assertEqual(store.bibliography['smith'], {'bib': 'Bib', 'long': 'Long', 'short': 'Short'})
+		self.assertEqual(store.urls['smith'], ('smith.org', 'Smith'))
+		self.assertEqual(store.urls.get('google'), ('www.google.com', 'Google'))
+		self.assertFalse('google' in store.bibliography)
+		self.assertRaises(KeyError, lambda: store.urls['bing'])
+
+	def testSaveAndLoad(self):
+		"""ReferenceStore should load a saved store as it was"""
+		store = ReferenceStore.parse(self.definitions)
+		path = os.path.join(self.directory.name, 'references.idx')
+		store.save(path)
+		loaded = ReferenceStore.load(path)
+		self.assertEqual(loaded.digest, store.digest)
+		self.assertEqual(loaded.urls['google'], ('www.google.com', 'Google'))
+
+	def testOpen(self):
+		"""ReferenceStore.open should index a Markdown file of definitions next to it and load the index"""
+		store = ReferenceStore.open(self.definitions)
+		self.assertEqual(store.path, self.definitions + '.idx')
+		self.assertEqual(ReferenceStore.open(store.path).digest, store.digest)
+
+	def testReopenWhileMapped(self):
+		"""ReferenceStore.open should replace a stale index rather than overwrite it, so stores still mapping it keep working"""
+		store = ReferenceStore.open(self.definitions)
+		with open(self.definitions, 'w') as definitions_file:
+			definitions_file.write('[google]: <www.google.org> "Google"\n')
+		later = os.path.getmtime(store.path) + 10
+		os.utime(self.definitions, (later, later))
+		self.assertEqual(ReferenceStore.open(self.definitions).urls['google'], ('www.google.org', 'Google'))
+		self.assertEqual(store.urls['google'], ('www.google.com', 'Google'))
+		self.assertEqual(sorted(os.listdir(self.directory.name)), ['references.md', 'references.md.idx'])
+
+	def testResolve(self):
+		"""MarkdownToLatex should fall back on the store for references the document does not define itself"""
+		store = ReferenceStore.parse(self.definitions)
+		test = 'See ^[smith][], ^[smith][] and [smith][] or ![google][].\n[smith]: local.org "Local"'
+		for single_pass in (False, True):
+			result = MarkdownToLatex(single_pass=single_pass, references=store).markdownify(test)
+			self.assertEqual(result, 'See Long, Short and \href{local.org}{Local} or \\begin{figure}\n\includegraphics{www.google.com}\n\caption{Google}\n\end{figure}.\n')
+
+	def testUnknownKey(self):
+		"""MarkdownToLatex should still raise a KeyError for references neither the document nor the store define"""
+		store = ReferenceStore.parse(self.definitions)
+		self.assertRaises(KeyError, MarkdownToLatex(references=store).markdownify, 'See [bing][].')
+
+class Server(unittest.TestCase):
+	async def request(self, port, method, path, body=b''):
+		reader, writer = await asyncio.open_connection('127.0.0.1', port)
+		writer.write(b'%s %s HTTP/1.1\r\nContent-Length: %d\r\nConnection: close\r\n\r\n' % (method, path, len(body)) + body)
+		status = int((await reader.readline()).split()[1])
+		response = json.loads((await reader.read()).split(b'\r\n\r\n', 1)[1])
+		writer.close()
+		return status, response
+
+	async def converse(self):
+		converter = ConversionServer(jobs=1, batch_size=8)
+		server = await converter.start('127.0.0.1:0')
+		port = server.sockets[0].getsockname()[1]
+		try:
+			texts = [('{"text": "*%d*", "template": "[%%BODY%%]"}' % index).encode() for index in range(20)]
+			results = await asyncio.gather(*(self.request(port, b'POST', b'/convert', text) for text in texts))
+			failed = await self.request(port, b'POST', b'/convert', b'{"text": "^[a][]"}')
+			malformed = await self.request(port, b'POST', b'/convert', b'text')
+			stats = await self.request(port, b'GET', b'/stats')
+		finally:
+			server.close()
+			converter.close()
+		return results, failed, malformed, stats
+
+	def testConversions(self):
+		"""ConversionServer should convert posted text in batches and report errors and stats"""
+		results, failed, malformed, stats = asyncio.run(self.converse())
+		self.assertEqual(results, [(200, {'latex': '[\\emph{%d}]' % index}) for index in range(20)])
+		self.assertEqual(failed, (422, {'error': "reference 'a' undefined"}))
+		self.assertEqual(malformed[0], 400)
+		self.assertEqual(stats[0], 200)
+		self.assertEqual((stats[1]['requests'], stats[1]['errors'], stats[1]['queued']), (21, 1, 0))
+		self.assertLess(stats[1]['batches'], 21)
+		self.assertEqual(sorted(stats[1]['latency_ms']), ['p50', 'p90', 'p99'])
+
+	async def convert(self, target, body):
+		converter = ConversionServer(jobs=1, target=target)
+		server = await converter.start('127.0.0.1:0')
+		try:
+			return await self.request(server.sockets[0].getsockname()[1], b'POST', b'/convert', body)
+		finally:
+			server.close()
+			converter.close()
+
+	def testTarget(self):
+		"""ConversionServer should render every conversion for its target"""
+		self.assertEqual(asyncio.run(self.convert(TARGETS['article'], b'{"text": "# T"}')), (200, {'latex': '\\section{T}'}))
+
 if __name__ == "__main__":
 	unittest.main()
\ No newline at end of file